@@ -0,0 +1,75 @@
+# Author: zyw
+# Date: 2026-10-18
+# Description: 数据增强的断点续跑清单, SQLite 文件, 每行记录一个已完成的输出 (utt, aug, copy, seed, params, path, size)
+
+import os
+import json
+import hashlib
+import sqlite3
+import threading
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+def params_hash(params):
+    """ 增强参数的摘要, 参数改变后旧的输出不再算完成 """
+    text = json.dumps(params or {}, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()[:16]
+
+
+class Manifest:
+    """
+    只由主进程写入, 记录保存在磁盘上, 内存占用与记录数无关. params 是 {增强类型: 影响该输出的参数},
+    重启时 done() 判断某个输出是否已完成 (记录存在, seed 和参数摘要相同, 文件大小一致),
+    已完成的输出直接复用, 不再重新生成. 可以在多个线程中调用.
+    """
+
+    def __init__(self, path, params=None):
+        self.path = path
+        self.hashes = {aug: params_hash(p) for aug, p in (params or {}).items()}
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS outputs (utt TEXT, aug TEXT, copy INTEGER, seed INTEGER, "
+                          "params TEXT, path TEXT, size INTEGER, PRIMARY KEY (utt, aug, copy))")
+        logger.info(f"从 {self.path} 读入 {len(self)} 条已完成的记录")
+
+    def __len__(self):
+        with self.lock:
+            return self.conn.execute("SELECT COUNT(*) FROM outputs").fetchone()[0]
+
+    def done(self, utt, aug, copy=0, seed=None):
+        """ 已完成时返回输出路径, 否则返回 None """
+        with self.lock:
+            row = self.conn.execute("SELECT seed, params, path, size FROM outputs WHERE utt = ? AND aug = ? AND copy = ?",
+                                    (utt, aug, copy)).fetchone()
+        if row is None or row[0] != seed or row[1] != self.hashes.get(aug, params_hash(None)):
+            return None
+        try:
+            if os.path.getsize(row[2]) != row[3]:
+                return None
+        except OSError:
+            return None
+        return row[2]
+
+    def add(self, utt, aug, copy, seed, path):
+        size = os.path.getsize(path)
+        with self.lock:
+            self.conn.execute("INSERT OR REPLACE INTO outputs VALUES (?, ?, ?, ?, ?, ?, ?)",
+                              (utt, aug, copy, seed, self.hashes.get(aug, params_hash(None)), path, size))
+
+    def flush(self):
+        with self.lock:
+            self.conn.commit()
+
+    def close(self):
+        with self.lock:
+            self.conn.commit()
+            self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -3,72 +3,165 @@
 # Description: 
 import os
 import json
+import time
 import argparse
 from pydub import AudioSegment
 import numpy as np
+import soundfile as sf
+from fractions import Fraction
+from scipy.signal import resample_poly
 import shutil
 from multiprocessing import Pool
+import itertools
+from collections import deque
 import logging
-from check_train_data import check_data_consistency
+from check_train_data import check_file_consistency
+from aug_manifest import Manifest
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s %(message)s')
 logger = logging.getLogger(__name__)
 
-def add_noise(audio_segment, noise_factor=0.02):
-    samples = np.array(audio_segment.get_array_of_samples())
-    noise = np.random.normal(0, 1, len(samples))
-    augmented_samples = samples + noise_factor * noise * np.max(samples)
-    augmented_audio = audio_segment._spawn(augmented_samples.astype(np.int16).tobytes())
-    return augmented_audio
-
-def speed_up(audio_segment, speed=1.5, min_duration=0.15):
-    if len(audio_segment) < min_duration * 1000:
-        #print(f"音频长度太短，返回原始音频。长度: {len(audio_segment)/1000:.2f}s")
-        return audio_segment
-    return audio_segment.speedup(playback_speed=speed)
-
-def slow_down(audio_segment, speed=0.85):
-    new_frame_rate = int(audio_segment.frame_rate * speed)
-    return audio_segment._spawn(audio_segment.raw_data, overrides={'frame_rate': new_frame_rate}).set_frame_rate(audio_segment.frame_rate)
+def load_audio(input_wav):
+    # 读成 (帧数, 声道数) 的 float32 缓冲, 所有增强都在这一份数据上进行
+    with sf.SoundFile(input_wav) as f:
+        samples = f.read(dtype='float32', always_2d=True)
+        return samples, f.samplerate, f.subtype
+
+def write_audio(output_wav, samples, sr, subtype):
+    # 与 int16 截断一致, 写出前限幅, 避免溢出
+    sf.write(output_wav, np.clip(samples, -1.0, 32767 / 32768), sr, subtype=subtype)
+
+def add_noise(samples, peak, noise_factor=0.02):
+    noise = np.random.standard_normal(samples.shape).astype(np.float32)
+    return samples + np.float32(noise_factor * peak) * noise
+
+def time_stretch(samples, sr, tempo, frame_ms=40, tolerance_ms=10):
+    """
+    WSOLA 变速不变调, samples 为 (帧数, 声道数) 的 float32, 输出长度约为 len(samples) / tempo.
+    每帧在名义位置 ±tolerance_ms 内选取与上一帧自然延续最相似的位置 (单声道混合上求互相关),
+    再用 50% 重叠的汉宁窗整体叠加.
+    """
+    if tempo == 1:
+        return samples.copy()
+    frame = max(4, int(sr * frame_ms / 1000) // 2 * 2)
+    hop = frame // 2
+    tol = int(sr * tolerance_ms / 1000)
+    out_len = int(round(len(samples) / tempo))
+    n_frames = out_len // hop + 1
+    channels = samples.shape[1]
+    # 前后补零, 保证候选区间和模板都不越界
+    tail = int(np.ceil(n_frames * hop * tempo)) - len(samples) + frame + 2 * tol + hop
+    x = np.pad(samples, ((tol, max(tail, 0) + tol), (0, 0)))
+    mono = x.mean(axis=1) if channels > 1 else x[:, 0]
+
+    positions = np.empty(n_frames, dtype=np.int64)
+    positions[0] = tol
+    for k in range(1, n_frames):
+        prev = positions[k - 1] + hop
+        template = mono[prev:prev + frame]
+        nominal = tol + int(round(k * hop * tempo))
+        region = mono[nominal - tol:nominal + tol + frame]
+        positions[k] = nominal - tol + int(np.argmax(np.correlate(region, template, 'valid')))
+
+    window = (0.5 - 0.5 * np.cos(2 * np.pi * np.arange(frame) / frame)).astype(np.float32)
+    frames = x[positions[:, None] + np.arange(frame)] * window[None, :, None]
+    out = np.zeros((n_frames + 1, hop, channels), dtype=np.float32)
+    out[:-1] += frames[:, :hop]
+    out[1:] += frames[:, hop:]
+    # 开头只有半个窗, 按窗函数之和归一化
+    norm = np.zeros((n_frames + 1, hop), dtype=np.float32)
+    norm[:-1] += window[:hop]
+    norm[1:] += window[hop:]
+    out = out.reshape(-1, channels) / np.maximum(norm.reshape(-1, 1), 1e-3)
+    return out[:out_len]
+
+def speed_up(samples, sr, speed=1.5, min_duration=0.15):
+    if len(samples) < min_duration * sr:
+        #print(f"音频长度太短，返回原始音频。长度: {len(samples)/sr:.2f}s")
+        return samples
+    return time_stretch(samples, sr, speed)
+
+def pydub_speed_up(samples, sr, speed=1.5):
+    # 旧的 AudioSegment.speedup 实现, 只用于 --check_speed_up 的对比
+    channels = samples.shape[1]
+    pcm = (np.clip(samples, -1.0, 32767 / 32768) * 32768).astype(np.int16)
+    audio_segment = AudioSegment(data=pcm.tobytes(), sample_width=2, frame_rate=sr, channels=channels)
+    fast_audio = audio_segment.speedup(playback_speed=speed)
+    fast = np.frombuffer(fast_audio.raw_data, dtype=np.int16).reshape(-1, channels)
+    return fast.astype(np.float32) / 32768
+
+def average_spectrum_db(samples, sr, n_fft=512):
+    mono = samples.mean(axis=1)
+    n = len(mono) // n_fft
+    frames = mono[:n * n_fft].reshape(n, n_fft) * np.hanning(n_fft)
+    power = np.mean(np.abs(np.fft.rfft(frames, axis=1)) ** 2, axis=0)
+    return 10 * np.log10(power + 1e-10)
+
+def check_speed_up(input_wav, speed=1.5):
+    """
+    对比 WSOLA 与 AudioSegment.speedup 的输出: 时长比和长时平均谱与原音频的距离 (dB),
+    变速不变调时平均谱应与原音频接近.
+    """
+    samples, sr, _ = load_audio(input_wav)
+    band = slice(int(100 / sr * 512), int(min(4000, sr / 2) / sr * 512))
+    reference = average_spectrum_db(samples, sr)[band]
+    results = {}
+    for name, func in (('wsola', speed_up), ('pydub', pydub_speed_up)):
+        start = time.perf_counter()
+        out = func(samples, sr, speed)
+        seconds = time.perf_counter() - start
+        distance = np.sqrt(np.mean((average_spectrum_db(out, sr)[band] - reference) ** 2))
+        results[name] = (len(out) / len(samples), distance, seconds)
+        logger.info(f"{name}: 时长比 {len(out) / len(samples):.4f} (目标 {1 / speed:.4f}), "
+                    f"平均谱距离 {distance:.2f} dB, 耗时 {seconds:.3f}s")
+    return results
+
+def slow_down(samples, sr, speed=0.85):
+    # 按 sr * speed 的采样率播放, 再重采样回 sr
+    new_frame_rate = int(sr * speed)
+    frac = Fraction(sr, new_frame_rate).limit_denominator(1000)
+    return resample_poly(samples, up=frac.numerator, down=frac.denominator, axis=0).astype(np.float32)
 
 def copy_dev_folder(source_dir, output_dir):
     dev_folder_path = os.path.join(source_dir, "dev")
     dest_path = os.path.join(output_dir, "dev")
 
     if os.path.exists(dev_folder_path):
-        shutil.copytree(dev_folder_path, dest_path) 
+        # 断点续跑时 dev 目录已由上一次运行复制过
+        shutil.copytree(dev_folder_path, dest_path, dirs_exist_ok=True)
     else:
         print(f"源文件夹 {dev_folder_path} 不存在")
 
-def process_audio(input_wav, output_wav_dir, key, augment_types):
-    audio = AudioSegment.from_wav(input_wav)
+def process_audio(input_wav, output_wav_dir, key, augment_types, tempo=1.5):
+    samples, sr, subtype = load_audio(input_wav)
 
-    if len(audio) < 1000:
-        #print(f"跳过音频：{input_wav}, 长度小于1秒, 长度: {len(audio)/1000:.2f}s")
+    if len(samples) < sr:
+        #print(f"跳过音频：{input_wav}, 长度小于1秒, 长度: {len(samples)/sr:.2f}s")
         return {}
 
     output_files = {}
     if 'noise' in augment_types:
-        noisy_audio = add_noise(audio)
+        peak = float(samples.max())
+        noisy_audio = add_noise(samples, peak)
         output_noise_path = os.path.join(output_wav_dir, f'noise_{key}.wav')
-        noisy_audio.export(output_noise_path, format="wav")
+        write_audio(output_noise_path, noisy_audio, sr, subtype)
         output_files['noise'] = output_noise_path
 
     if 'fast' in augment_types:
-        fast_audio = speed_up(audio)
+        fast_audio = speed_up(samples, sr, tempo)
         output_fast_path = os.path.join(output_wav_dir, f'fast_{key}.wav')
-        fast_audio.export(output_fast_path, format="wav")
+        write_audio(output_fast_path, fast_audio, sr, subtype)
         output_files['fast'] = output_fast_path
 
     if 'slow' in augment_types:
-        slow_audio = slow_down(audio)
+        slow_audio = slow_down(samples, sr)
         output_slow_path = os.path.join(output_wav_dir, f'slow_{key}.wav')
-        slow_audio.export(output_slow_path, format="wav")
+        write_audio(output_slow_path, slow_audio, sr, subtype)
         output_files['slow'] = output_slow_path
 
     return output_files
 
-def handle_line(wav_scp_line, text_line, data_list_line, output_wav_dir, augment_types):
+def handle_line(wav_scp_line, text_line, data_list_line, output_wav_dir, augment_types, tempo=1.5, done=None):
     try:        
         parts = wav_scp_line.strip().split(maxsplit=1)
         logger.info(f"处理音频文件: {wav_scp_line.strip()}")
@@ -88,7 +181,16 @@ def handle_line(wav_scp_line, text_line, data_list_line, output_wav_dir, augment
         wav_file = data_list_entry['wav']
         txt = data_list_entry['txt']
 
-        output_files = process_audio(wav_file, output_wav_dir, key, augment_types)
+        # done 是清单中已完成的 {增强类型: 输出路径}, 只生成缺少的增强
+        done = done or {}
+        todo = [aug_type for aug_type in augment_types if aug_type not in done]
+        new_files = process_audio(wav_file, output_wav_dir, key, todo, tempo) if todo else {}
+        output_files = {}
+        for aug_type in ('noise', 'fast', 'slow'):
+            if aug_type in done:
+                output_files[aug_type] = done[aug_type]
+            elif aug_type in new_files:
+                output_files[aug_type] = new_files[aug_type]
 
         # 确保每个增强的音频都写入 wav.scp 和 text 文件
         wav_scp_entries = []
@@ -108,7 +210,33 @@ def handle_line(wav_scp_line, text_line, data_list_line, output_wav_dir, augment
         return None
 
 
-def augment_data(input_dir, output_dir, augment_types=['noise', 'fast', 'slow'], num_processes=4):
+def read_tasks(wav_scp_path, text_path, data_list_path, output_wav_dir, augment_types, tempo, manifest=None):
+    # 逐行读取三个输入文件, 在主进程中按需生成任务
+    with open(wav_scp_path, 'r') as wav_scp_file, open(text_path, 'r') as text_file, open(data_list_path, 'r') as data_list_file:
+        for wav_scp_line, text_line, data_list_line in zip(wav_scp_file, text_file, data_list_file):
+            done = {}
+            parts = wav_scp_line.split(maxsplit=1)
+            if manifest is not None and parts:
+                for aug_type in augment_types:
+                    path = manifest.done(parts[0], aug_type)
+                    if path is not None:
+                        done[aug_type] = path
+            yield wav_scp_line, text_line, data_list_line, output_wav_dir, augment_types, tempo, done
+
+def handle_chunk(tasks):
+    return [handle_line(*task) for task in tasks]
+
+def format_result(result):
+    wav_key, txt, wav_path, wav_scp_entries, text_entries, output_files = result  # 获取 wav_path 和 output_files
+    # data.list 相关数据，包括原始文件
+    data_list_entries = [json.dumps({"key": wav_key, "wav": wav_path, "txt": txt}, ensure_ascii=False) + "\n"]
+    for aug_type, aug_wav_path in output_files.items():
+        new_data_entry = {"key": f"{aug_type}_{wav_key}", "wav": aug_wav_path, "txt": txt}
+        data_list_entries.append(json.dumps(new_data_entry, ensure_ascii=False) + "\n")
+    return wav_scp_entries, text_entries, data_list_entries
+
+def augment_data(input_dir, output_dir, augment_types=['noise', 'fast', 'slow'], num_processes=4, tempo=1.5,
+                 chunksize=16, flush_every=1000, manifest_path=None):
     wav_scp_path = os.path.join(input_dir, 'wav.scp')
     text_path = os.path.join(input_dir, 'text')
     data_list_path = os.path.join(input_dir, 'data.list')
@@ -128,46 +256,77 @@ def augment_data(input_dir, output_dir, augment_types=['noise', 'fast', 'slow'],
 
     copy_dev_folder("/data2/cuidc/data/data_20231123", output_dir)
 
-    with open(wav_scp_path, 'r') as wav_scp_file, open(text_path, 'r') as text_file, open(data_list_path, 'r') as data_list_file:
-        wav_scp_lines = wav_scp_file.readlines()
-        text_lines = text_file.readlines()
-        data_list_lines = data_list_file.readlines()
-        check_data_consistency(wav_scp_lines, text_lines, data_list_lines)
-
-        with Pool(num_processes) as pool, open(output_wav_scp, 'w') as wav_scp_out, open(output_text, 'w') as text_out, open(output_data_list, 'w') as data_list_out:
-            tasks = [(wav_scp_line, text_line, data_list_line, output_wav_dir, augment_types)
-                     for wav_scp_line, text_line, data_list_line in zip(wav_scp_lines, text_lines, data_list_lines)]
-
-            for result in pool.starmap(handle_line, tasks):
-                if result is None:
-                    continue
-                wav_key, txt, wav_path, wav_scp_entries, text_entries, output_files = result  # 获取 wav_path 和 output_files
-
-                # 写入 wav.scp 相关数据
-                for entry in wav_scp_entries:
-                    wav_scp_out.write(entry)
-
-                # 写入 text 相关数据
-                for text_entry in text_entries:
-                    text_out.write(text_entry)
-
-                # 写入 data.list 相关数据，包括原始文件
-                data_list_out.write(json.dumps({"key": wav_key, "wav": wav_path, "txt": txt}, ensure_ascii=False) + "\n")
-                
-                for aug_type, aug_wav_path in output_files.items():
-                    new_data_entry = {"key": f"{aug_type}_{wav_key}", "wav": aug_wav_path, "txt": txt}
-                    data_list_out.write(json.dumps(new_data_entry, ensure_ascii=False) + "\n")
+    check_file_consistency(wav_scp_path, text_path, data_list_path)
+
+    # 断点续跑: 清单中已完成的增强音频直接复用, 输出文件按输入顺序重新生成
+    # 参数改变 (如 tempo) 的增强类型会重新生成
+    manifest = Manifest(manifest_path or os.path.join(output_dir, 'aug_manifest.sqlite'),
+                        params={'noise': {}, 'fast': {'tempo': tempo}, 'slow': {}})
+
+    tasks = read_tasks(wav_scp_path, text_path, data_list_path, output_wav_dir, augment_types, tempo, manifest)
+    chunks = iter(lambda: list(itertools.islice(tasks, max(chunksize, 1))), [])
+    # 在途的块数有上限, 内存与输入行数无关; 只在主线程派发, 出错或中断时 Pool 可以直接终止
+    max_pending = num_processes * 4
+    buffers = ([], [], [])
+    done = 0
+    with manifest, Pool(num_processes) as pool, open(output_wav_scp, 'w') as wav_scp_out, open(output_text, 'w') as text_out, open(output_data_list, 'w') as data_list_out:
+        outputs = (wav_scp_out, text_out, data_list_out)
+
+        def flush():
+            # 三个文件一起写出, 中断时输出是按输入顺序的完整前缀
+            for out, buffer in zip(outputs, buffers):
+                out.writelines(buffer)
+                out.flush()
+                buffer.clear()
+            manifest.flush()
+
+        def collect(results):
+            nonlocal done
+            for result in results:
+                done += 1
+                if result is not None:
+                    wav_key, output_files = result[0], result[5]
+                    for aug_type, aug_wav_path in output_files.items():
+                        if manifest.done(wav_key, aug_type) != aug_wav_path:
+                            manifest.add(wav_key, aug_type, 0, None, aug_wav_path)
+                    for buffer, entries in zip(buffers, format_result(result)):
+                        buffer.extend(entries)
+                if done % flush_every == 0:
+                    flush()
+                    logger.info(f"已处理 {done} 行")
+
+        # 按派发顺序取回结果, 输出保持输入顺序
+        window = deque()
+        for chunk in chunks:
+            window.append(pool.apply_async(handle_chunk, (chunk,)))
+            if len(window) >= max_pending:
+                collect(window.popleft().get())
+        while window:
+            collect(window.popleft().get())
+        flush()
 
     print(f"数据增强处理完成, WAV文件保存在 {output_wav_dir}, data.list, wav.scp, text 文件保存在 {train_folder}")
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="处理ASR数据增强,生成新的wav.scp, text, data.list文件")
-    parser.add_argument('input_dir', help='输入文件目录,包含wav.scp, text, data.list文件')
-    parser.add_argument('output_dir', help='输出目录，保存增强后的文件')
+    parser.add_argument('input_dir', nargs='?', help='输入文件目录,包含wav.scp, text, data.list文件')
+    parser.add_argument('output_dir', nargs='?', help='输出目录，保存增强后的文件')
     parser.add_argument('--augment_types', nargs='+', default=['noise', 'fast', 'slow'], help='选择要进行的数据增强类型')
     parser.add_argument('--num_processes', type=int, default=4, help='并行处理的进程数量,默认为4')
+    parser.add_argument('--chunksize', type=int, default=16, help='每次派发给子进程的行数,默认为16')
+    parser.add_argument('--manifest', help='断点续跑清单的路径,默认为 output_dir/aug_manifest.sqlite')
+    parser.add_argument('--tempo', type=float, default=1.5, help='fast 增强的变速倍数 (不变调), 默认为1.5')
+    parser.add_argument('--check_speed_up', help='对比该 wav 上 WSOLA 与 AudioSegment.speedup 的输出后退出')
 
     args = parser.parse_args()
 
-    augment_data(args.input_dir, args.output_dir, args.augment_types, args.num_processes)
+    if args.tempo <= 0:
+        parser.error('--tempo 必须大于0')
+    if args.check_speed_up:
+        check_speed_up(args.check_speed_up, args.tempo)
+    elif args.input_dir is None or args.output_dir is None:
+        parser.error('需要 input_dir 和 output_dir')
+    else:
+        augment_data(args.input_dir, args.output_dir, args.augment_types, args.num_processes, args.tempo,
+                     args.chunksize, manifest_path=args.manifest)
@@ -7,9 +7,19 @@ import soundfile as sf
 from pathlib import Path
 from fractions import Fraction
 from scipy.signal import resample_poly, fftconvolve, butter, sosfiltfilt
+from scipy import fft as sfft
 from funasr import AutoModel
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed, Future
+from collections import deque, OrderedDict
+import multiprocessing
 import threading
+import queue
+import sqlite3
+import json
+import shutil
+import tempfile
+from array import array
+from aug_manifest import Manifest
 
 class My_utils():
     def read_scp(self, scp_path):
@@ -124,23 +134,46 @@ class My_utils():
                 seg = f.read(frames, dtype="float32", always_2d=True)
             seg = self.to_mono(seg)
             seg = np.clip(seg, -1.0, 1.0).astype(np.float32)
-            if sr_src != sr_target:
-                seg = self.resample(seg, sr_src, sr_target)
-            if len(seg) < target_len:
-                reps = int(np.ceil(target_len / max(1, len(seg))))
-                seg = np.tile(seg, reps)[:target_len]
-            elif len(seg) > target_len:
-                s = int(rng.integers(0, len(seg) - target_len + 1))
-                seg = seg[s:s + target_len]
-            return seg.astype(np.float32)
+        return self.fit_segment(seg, sr_src, target_len, sr_target, rng)
+
+    def fit_segment(self, seg, sr_src, target_len, sr_target, rng):
+        if sr_src != sr_target:
+            seg = self.resample(seg, sr_src, sr_target)
+        if len(seg) < target_len:
+            reps = int(np.ceil(target_len / max(1, len(seg))))
+            seg = np.tile(seg, reps)[:target_len]
+        elif len(seg) > target_len:
+            s = int(rng.integers(0, len(seg) - target_len + 1))
+            seg = seg[s:s + target_len]
+        return seg.astype(np.float32)
+
+    def load_segment_source(self, path, sr_target=0):
+        # the whole file decoded exactly like load_random_segment reads a part of it,
+        # resampled once to sr_target unless it is 0
+        with sf.SoundFile(path, mode='r') as f:
+            seg = f.read(dtype='float32', always_2d=True)
+            sr = f.samplerate
+        seg = self.to_mono(seg)
+        seg = np.clip(seg, -1.0, 1.0).astype(np.float32)
+        if sr_target and sr != sr_target and len(seg) > 0:
+            seg, sr = self.resample(seg, sr, sr_target), sr_target
+        return seg, sr
 
     def load_random_rir(self, rir_path, sr_target):
         y, sr = self.load_audio_mono(rir_path)
+        return self.prepare_rir(y, sr, sr_target)
+
+    def prepare_rir(self, y, sr, sr_target):
         if sr != sr_target:
             y = self.resample(y, sr, sr_target)
         y = y / (np.max(np.abs(y)) + 1e-9)
         return y.astype(np.float32)
 
+    def reverberate(self, y, rir_path, sr, rir_volume):
+        rir = self.load_random_rir(rir_path, sr)
+        rir = rir_volume * rir
+        return self.convolve_rir(y, rir)
+
     def mix_background_at_snr(self, speech, bg_seg, snr_db):
         rs = self.rms(speech)
         rn = self.rms(bg_seg)
@@ -187,9 +220,7 @@ class My_utils():
             
             if rir_list and len(rir_list) > 0 and (rng.random() < rir_prob):
                 r_utt, r_path = rir_list[int(rng.integers(0, len(rir_list)))]
-                rir = self.load_random_rir(r_path, sr)
-                rir = rir_volume * rir
-                raw = self.convolve_rir(raw, rir)
+                raw = self.reverberate(raw, r_path, sr, rir_volume)
             
             if len(raw) > seg_len:
                 raw = raw[:seg_len]
@@ -215,6 +246,445 @@ class My_utils():
         mixed = speech.astype(np.float32) + beta * interf_sum.astype(np.float32)
         return mixed.astype(np.float32)
 
+def file_stamp(path):
+    try:
+        st = os.stat(path)
+    except OSError:
+        return -1, -1
+    return st.st_size, st.st_mtime_ns
+
+class AudioBank():
+    """
+    many decoded files in one float32 blob, memory mapped read-only so
+    every worker process shares the same pages; the json index keeps the
+    rate the bank was built at (0 for native rates) and maps each path to
+    [offset, length, sample rate, size, mtime_ns], offset -1 when the file
+    failed to decode
+    """
+    def __init__(self, prefix):
+        with open(prefix + ".json", "r", encoding="utf-8") as f:
+            index = json.load(f)
+        self.sr = index["sr"]
+        self.files = index["files"]
+        if os.path.getsize(prefix + ".f32") > 0:
+            self.blob = np.asarray(np.memmap(prefix + ".f32", dtype=np.float32, mode="r"))
+        else:
+            self.blob = np.zeros(0, dtype=np.float32)
+
+    @staticmethod
+    def build(prefix, paths, decode, sr=0):
+        files = {}
+        offset = 0
+        with open(prefix + ".f32.tmp", "wb") as f:
+            for i, path in enumerate(dict.fromkeys(paths)):
+                size, mtime_ns = file_stamp(path)
+                try:
+                    y, y_sr = decode(path)
+                except Exception as e:
+                    # kept as failed, the mixing falls back to the file and reports it there
+                    print(f"[WARN] failed to decode {path} into the bank ({e})", file=sys.stderr)
+                    files[path] = [-1, 0, 0, size, mtime_ns]
+                    continue
+                y = np.ascontiguousarray(y, dtype=np.float32)
+                f.write(y.tobytes())
+                files[path] = [offset, len(y), int(y_sr), size, mtime_ns]
+                offset += len(y)
+                if (i + 1) % 1000 == 0:
+                    print(f"[INFO] bank {prefix}: {i + 1} files decoded", file=sys.stderr)
+        with open(prefix + ".json.tmp", "w", encoding="utf-8") as f:
+            json.dump({"sr": sr, "files": files}, f, ensure_ascii=False)
+        # blob first, an index is never left pointing at a shorter blob
+        os.replace(prefix + ".f32.tmp", prefix + ".f32")
+        os.replace(prefix + ".json.tmp", prefix + ".json")
+        return AudioBank(prefix)
+
+    @staticmethod
+    def open(prefix, paths, decode, sr=0):
+        """ reuses the bank at prefix if it was built at sr and every path in it is unchanged, rebuilds it otherwise """
+        try:
+            bank = AudioBank(prefix)
+        except (OSError, ValueError, KeyError):
+            bank = None
+        if bank is not None:
+            stale = bank.stale(paths) if bank.sr == sr else "built at another rate"
+            if not stale:
+                return bank
+            print(f"[INFO] rebuilding bank {prefix}: {stale}", file=sys.stderr)
+        return AudioBank.build(prefix, paths, decode, sr)
+
+    def stale(self, paths):
+        for path in paths:
+            entry = self.files.get(path)
+            if entry is None:
+                return f"{path} is not in it"
+            if tuple(entry[3:5]) != file_stamp(path):
+                return f"{path} has changed"
+        return None
+
+    def __len__(self):
+        return sum(1 for entry in self.files.values() if entry[0] >= 0)
+
+    def get(self, path):
+        entry = self.files.get(path)
+        if entry is None or entry[0] < 0:
+            return None
+        offset, length, sr = entry[:3]
+        return self.blob[offset:offset + length], sr
+
+class BankUtils(My_utils):
+    """
+    My_utils reading interferer, background and RIR audio from AudioBank
+    views instead of the files; the random draws are the same, so with a
+    native rate bank the output matches My_utils sample for sample, with
+    a bank at the target rate every segment is a plain slice
+    """
+    def __init__(self, segments=None, rirs=None, rir_cache_bytes=256 << 20):
+        self.segments = segments
+        self.rirs = RirBank(self, rirs, rir_cache_bytes)
+
+    def load_random_segment(self, path, target_len, sr_target, rng):
+        entry = self.segments.get(path) if self.segments is not None else None
+        if entry is None:
+            return super().load_random_segment(path, target_len, sr_target, rng)
+        y, sr_src = entry
+        frames = len(y)
+        if frames == 0:
+            return np.zeros(target_len, dtype=np.float32)
+        need_src = target_len if sr_src == sr_target else int(np.ceil(target_len * sr_src / sr_target))
+        if frames >= need_src:
+            starts = int(rng.integers(0, frames - need_src + 1))
+            seg = y[starts:starts + need_src]
+        else:
+            seg = y
+        return self.fit_segment(seg, sr_src, target_len, sr_target, rng)
+
+    def load_random_rir(self, rir_path, sr_target):
+        return self.rirs.rir(rir_path, sr_target)
+
+    def reverberate(self, y, rir_path, sr, rir_volume):
+        return self.rirs.convolve(y, rir_path, sr, rir_volume)
+
+def next_pow2(n):
+    return 1 << max(0, int(n) - 1).bit_length()
+
+class RirBank():
+    """
+    RIRs resampled to the mixing rate and peak-normalized once, and their
+    rfft kernels for each power-of-two FFT size they are used with, kept
+    in one LRU bounded by bytes; source is an optional AudioBank the RIRs
+    are read from instead of the files
+    """
+    # smallest overlap-add FFT, short RIRs still get blocks of a useful size
+    MIN_BLOCK_NFFT = 4096
+
+    def __init__(self, utils, source=None, max_bytes=256 << 20):
+        self.utils = utils
+        self.source = source
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.cache = OrderedDict()
+        self.nbytes = 0
+
+    def cached(self, key, make):
+        with self.lock:
+            value = self.cache.get(key)
+            if value is not None:
+                self.cache.move_to_end(key)
+                return value
+        # built outside the lock, two threads may both build it, the values are the same
+        value = make()
+        with self.lock:
+            if key not in self.cache:
+                self.cache[key] = value
+                self.nbytes += value.nbytes
+                while self.nbytes > self.max_bytes and len(self.cache) > 1:
+                    _, old = self.cache.popitem(last=False)
+                    self.nbytes -= old.nbytes
+        return value
+
+    def rir(self, path, sr):
+        def make():
+            entry = self.source.get(path) if self.source is not None else None
+            if entry is None:
+                y, sr_src = self.utils.load_audio_mono(path)
+            else:
+                y, sr_src = entry
+            return self.utils.prepare_rir(y, sr_src, sr)
+        return self.cached(("rir", path, sr), make)
+
+    def kernel(self, path, sr, volume, nfft):
+        return self.cached(("fft", path, sr, volume, nfft),
+                           lambda: sfft.rfft(np.float32(volume) * self.rir(path, sr), nfft))
+
+    def convolve(self, y, path, sr, volume):
+        """ same as My_utils.convolve_rir(y, volume * rir) but in float32 with cached kernels """
+        rir = self.rir(path, sr)
+        n, m = len(y), len(rir)
+        if m == 0:
+            return y
+        y = y.astype(np.float32)
+        full = n + m - 1
+        block_nfft = max(self.MIN_BLOCK_NFFT, next_pow2(2 * m))
+        nfft = next_pow2(full)
+        if nfft <= 2 * block_nfft:
+            out = sfft.irfft(sfft.rfft(y, nfft) * self.kernel(path, sr, volume, nfft), nfft)[:full]
+        else:
+            # overlap-add in blocks of half the FFT size, with m <= half each block only spills into the next one
+            half = block_nfft // 2
+            nb = -(-n // half)
+            blocks = np.zeros(nb * half, dtype=np.float32)
+            blocks[:n] = y
+            res = sfft.irfft(sfft.rfft(blocks.reshape(nb, half), block_nfft, axis=1)
+                             * self.kernel(path, sr, volume, block_nfft), block_nfft, axis=1)
+            out = np.zeros((nb + 1) * half, dtype=np.float32)
+            out[:nb * half] += res[:, :half].ravel()
+            out[half:] += res[:, half:].ravel()
+            out = out[:full]
+        ry = self.utils.rms(y)
+        ro = self.utils.rms(out)
+        if ro > 1e-9:
+            out = out * (ry / ro)
+        return out.astype(np.float32)
+
+class Mixer():
+    """
+    mixes the copies of one utterance and writes them; the thread backend
+    calls it directly, the process backend keeps one per worker process
+    """
+    def __init__(self, args, utils, interfere_pairs, bg_pairs, rir_pairs, wav_dir):
+        self.args = args
+        self.utils = utils
+        self.interfere_pairs = interfere_pairs
+        self.bg_pairs = bg_pairs
+        self.rir_pairs = rir_pairs
+        self.wav_dir = wav_dir
+
+    def load(self, t_utt, t_path):
+        try:
+            speech, sr_t = self.utils.load_audio_mono(t_path)
+        except Exception as e:
+            print(f"[WARN] failed read wav:{t_utt} -> {t_path} ({e}), skip", file=sys.stderr)
+            return None
+        if len(speech) <= 0:
+            print(f"[WARN] empty wav:{t_utt} -> {t_path}, skip .", file=sys.stderr)
+            return None
+        return speech, sr_t
+
+    def run(self, t_utt, t_path, raw_vad, todo, base_seed):
+        loaded = self.load(t_utt, t_path)
+        if loaded is None:
+            return []
+        return self.mix(t_utt, *loaded, raw_vad, todo, base_seed)
+
+    def mix(self, t_utt, speech, sr_t, raw_vad, todo, base_seed):
+        """ returns [(copy, out_path)] of the copies written """
+        args = self.args
+        utils = self.utils
+        bg_pairs = self.bg_pairs
+        L = len(speech)
+        seg_samples = [seg_ms_to_samples(seg, sr_t, L) for seg in raw_vad]
+        if not seg_samples:
+            seg_samples = [(0, L)]
+        written = []
+
+        for c in todo:
+            mixed = speech.copy().astype(np.float32)
+            rng = np.random.default_rng(base_seed + c + 1)
+            for (start, end) in seg_samples:
+                if end - start <= 0:
+                    continue  
+                seg_view = mixed[start:end].copy()
+                
+                if bg_pairs and (rng.random() < args.bg_prob):
+                    bg_utt, bg_path = bg_pairs[int(rng.integers(0, len(bg_pairs)))]
+                    
+                    try:
+                        bg_seg = utils.load_random_segment(bg_path, end - start, sr_t, rng)
+                        snr_db = float(rng.uniform(args.snr_min, args.snr_max))
+                        seg_view = utils.mix_background_at_snr(seg_view, bg_seg, snr_db)
+                    except Exception as e:
+                        print(f"[WARN] failed read background noise: {bg_utt} -> {bg_path} ({e}), skip.", file=sys.stderr)
+                
+                try:
+                    interf_sum = utils.build_interference_sum(
+                        end - start, sr_t, self.interfere_pairs, rng,
+                        overlap_min=args.overlap_min, overlap_max=args.overlap_max,
+                        max_interferers=args.max_interferers, speed_prob=args.speed_prob,
+                        speed_min=args.speed_min, speed_max=args.speed_max,
+                        filter_prob=args.filter_prob, rir_prob=args.rir_prob, rir_list=self.rir_pairs,
+                        rir_volume=args.rir_volume
+                    )
+                    sir_db = float(rng.uniform(args.sir_min, args.sir_max))
+                    seg_view = utils.mix_interferers_at_sir(seg_view, interf_sum, sir_db)
+                
+                except Exception as e:
+                    print(f"[WARN] Failed to mix interferer for {t_utt}: {e}.", file=sys.stderr)
+                mixed[start:end] = seg_view
+
+            mixed = utils.peak_normalize(mixed, peak_margin=args.peak_margin)
+            suffix = f"_aug{c+1}" if args.copies > 1 else "_aug1"
+            out_name = f"{t_utt}{suffix}.wav"
+            out_path = str(self.wav_dir / out_name)
+
+            try:
+                sf.write(out_path, mixed, sr_t, subtype="PCM_16")
+            
+            except Exception as e:
+                print(f"[WARN] failed to write file:{out_path} ({e}), skip.", file=sys.stderr)
+                continue
+            written.append((c, out_path))
+        return written
+
+mix_worker = None
+
+def init_mix_worker(args, bank_prefix, interfere_pairs, bg_pairs, rir_pairs, wav_dir):
+    global mix_worker
+    utils = BankUtils(AudioBank(bank_prefix + "_seg"), AudioBank(bank_prefix + "_rir"), args.rir_cache_mb << 20)
+    mix_worker = Mixer(args, utils, interfere_pairs, bg_pairs, rir_pairs, wav_dir)
+
+def run_mix_worker(t_utt, t_path, raw_vad, todo, base_seed):
+    return mix_worker.run(t_utt, t_path, raw_vad, todo, base_seed)
+
+class VadCache():
+    """
+    sidecar sqlite index of fsmn-vad segments, keyed by wav path and
+    validated against its size and mtime; segments are kept as a flat
+    int64 array of [start_ms, end_ms] pairs
+    """
+    def __init__(self, path, commit_every=200):
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("CREATE TABLE IF NOT EXISTS vad (path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, segs BLOB)")
+        self.commit_every = commit_every
+        self.pending = 0
+        self.hits = 0
+        self.misses = 0
+
+    def stat(self, path):
+        st = os.stat(path)
+        return st.st_size, st.st_mtime_ns
+
+    def get(self, path):
+        size, mtime_ns = self.stat(path)
+        with self.lock:
+            row = self.conn.execute("SELECT size, mtime_ns, segs FROM vad WHERE path = ?", (path,)).fetchone()
+            if row is None or row[0] != size or row[1] != mtime_ns:
+                self.misses += 1
+                return None
+            self.hits += 1
+        segs = array('q')
+        segs.frombytes(row[2])
+        return [[segs[i], segs[i + 1]] for i in range(0, len(segs), 2)]
+
+    def put(self, path, segs):
+        size, mtime_ns = self.stat(path)
+        flat = array('q', [int(v) for seg in segs for v in seg[:2]])
+        with self.lock:
+            self.conn.execute("INSERT OR REPLACE INTO vad VALUES (?, ?, ?, ?)", (path, size, mtime_ns, flat.tobytes()))
+            self.pending += 1
+            if self.pending >= self.commit_every:
+                self.conn.commit()
+                self.pending = 0
+
+    def close(self):
+        with self.lock:
+            self.conn.commit()
+            self.conn.close()
+
+class VadWorkers():
+    """
+    VAD as its own pipeline stage: worker threads, each with its own
+    fsmn-vad model on CPU, pull wav paths from a queue, run them in
+    batches of up to batch_size and resolve one Future per path with its
+    segments, so mixing threads only wait for their own file
+    """
+    def __init__(self, make_model, num_workers=1, batch_size=8, cache=None):
+        self.make_model = make_model
+        self.batch_size = max(1, batch_size)
+        self.cache = cache
+        self.tasks = queue.Queue()
+        self.threads = [threading.Thread(target=self.run, daemon=True) for _ in range(max(1, num_workers))]
+        for t in self.threads:
+            t.start()
+
+    def submit(self, path):
+        fut = Future()
+        if self.cache is not None:
+            try:
+                segs = self.cache.get(path)
+            except OSError as e:
+                # missing or unreadable wav, reported by the caller like a VAD failure
+                fut.set_exception(e)
+                return fut
+            if segs is not None:
+                fut.set_result(segs)
+                return fut
+        self.tasks.put((path, fut))
+        return fut
+
+    def next_batch(self):
+        item = self.tasks.get()
+        if item is None:
+            # pass the stop signal on to the other workers
+            self.tasks.put(None)
+            return None
+        batch = [item]
+        while len(batch) < self.batch_size:
+            try:
+                item = self.tasks.get_nowait()
+            except queue.Empty:
+                break
+            if item is None:
+                self.tasks.put(None)
+                break
+            batch.append(item)
+        return batch
+
+    def run(self):
+        model = None
+        while True:
+            batch = self.next_batch()
+            if batch is None:
+                break
+            try:
+                if model is None:
+                    # loaded on the first cache miss of this worker
+                    model = self.make_model()
+                paths = [path for path, _ in batch]
+                res = model.generate(input=paths) if len(paths) > 1 else model.generate(input=paths[0])
+                if len(res) != len(paths):
+                    raise ValueError(f"{len(res)} results for {len(paths)} inputs")
+            except Exception:
+                if model is None or len(batch) == 1:
+                    for _, fut in batch:
+                        fut.set_exception(sys.exc_info()[1])
+                    continue
+                # one bad file fails the whole batch, retry one by one
+                res = []
+                for path, fut in batch:
+                    try:
+                        res.append(model.generate(input=path)[0])
+                    except Exception as e:
+                        res.append(e)
+            for (path, fut), r in zip(batch, res):
+                if isinstance(r, Exception):
+                    fut.set_exception(r)
+                    continue
+                # every Future is resolved, a waiting mixing thread never blocks on a dead worker
+                try:
+                    segs = r.get("value", [])
+                    if self.cache is not None:
+                        self.cache.put(path, segs)
+                except Exception as e:
+                    fut.set_exception(e)
+                    continue
+                fut.set_result(segs)
+
+    def close(self):
+        self.tasks.put(None)
+        for t in self.threads:
+            t.join()
+
 def parse_args():
     ap = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
     ap.add_argument("--in-dir", required=True)
@@ -223,7 +693,7 @@ def parse_args():
     ap.add_argument("--in-text-name", default="text")
     ap.add_argument("--out-scp-name", default="wav.scp")
     ap.add_argument("--out-text-name", default="text")
-    ap.add_argument("--interfere-scp", required=True)
+    ap.add_argument("--interfere-scp", default=None, help="required unless --vad-prefill")
     ap.add_argument("--sir-min", type=float, default=0.0)
     ap.add_argument("--sir-max", type=float, default=10.0)
     ap.add_argument("--max-interferers", type=int, default=2)
@@ -243,7 +713,22 @@ def parse_args():
     ap.add_argument("--peak-margin", type=float, default=0.999)
     ap.add_argument("--seed", type=int, default=0)
     ap.add_argument("--rir_volume", type=float, default=0.6)
+    ap.add_argument("--rir-cache-mb", type=int, default=256, help="LRU of prepared RIRs and their FFT kernels, per mixing process")
     ap.add_argument("--num-workers", type=int, default=8)
+    ap.add_argument("--backend", choices=["thread", "process"], default="thread",
+                    help="run the mixing in threads, or in worker processes reading memory-mapped audio banks")
+    ap.add_argument("--bank-dir", default=None,
+                    help="persistent interferer/background/RIR audio banks, used by both backends and rebuilt when a file changes; "
+                         "the process backend uses a temp dir in --out-dir without it")
+    ap.add_argument("--bank-sr", type=int, default=None,
+                    help="rate interferer and background audio is resampled to once in the bank, 0 keeps the native rates; "
+                         "default 16000 with --bank-dir, else 0 so both backends write the same audio as reading the files")
+    ap.add_argument("--prepare-bank", action="store_true", help="only build or refresh the banks in --bank-dir, then exit")
+    ap.add_argument("--manifest", default=None, help="resume manifest, default <out-dir>/aug_manifest.sqlite")
+    ap.add_argument("--vad-cache", default=None, help="VAD segment cache, default <in-dir>/vad_cache.sqlite, 'none' to disable")
+    ap.add_argument("--vad-prefill", action="store_true", help="only run VAD over the train list to fill --vad-cache, then exit")
+    ap.add_argument("--vad-workers", type=int, default=1, help="VAD threads, each with its own model on CPU")
+    ap.add_argument("--vad-batch", type=int, default=8, help="max wav files per VAD inference call")
     return ap.parse_args()
 
 def seg_ms_to_samples(seg, sr, total_len):
@@ -285,6 +770,40 @@ def main():
     text_map = utils.read_text(str(in_text))
     if not text_map:
         print("[ERROR] text is empty or error", file=sys.stderr); sys.exit(1)
+
+    vad_cache = None
+    vad_cache_path = args.vad_cache or str(Path(args.in_dir) / "vad_cache.sqlite")
+    if vad_cache_path.lower() != "none":
+        try:
+            vad_cache = VadCache(vad_cache_path)
+        except sqlite3.Error as e:
+            print(f"[WARN] failed to open VAD cache {vad_cache_path} ({e}), run without it.", file=sys.stderr)
+    def make_vad_model():
+        return AutoModel(model="../SenseVoice/fsmn_vad", model_revision="v2.0.4", device="cpu", disable_update=True)
+
+    if args.vad_prefill:
+        if vad_cache is None:
+            print("[ERROR] --vad-prefill needs a VAD cache", file=sys.stderr); sys.exit(1)
+        vad = VadWorkers(make_vad_model, args.vad_workers, args.vad_batch, vad_cache)
+        # keep a bounded window of files in flight so every worker gets full batches
+        window = deque()
+        max_pending = max(1, args.vad_workers) * max(1, args.vad_batch) * 4
+        for i, (t_utt, t_path) in enumerate(train_pairs):
+            window.append((t_utt, vad.submit(t_path)))
+            while len(window) > max_pending or (i + 1 == len(train_pairs) and window):
+                w_utt, fut = window.popleft()
+                try:
+                    fut.result()
+                except Exception as e:
+                    print(f"[WARN] VAD failed for {w_utt}: {e}", file=sys.stderr)
+            if (i + 1) % 100 == 0 or i + 1 == len(train_pairs):
+                print(f"[INFO] VAD prefill: {i + 1}/{len(train_pairs)}, cached {vad_cache.hits}, new {vad_cache.misses}", file=sys.stderr)
+        vad.close()
+        vad_cache.close()
+        return
+
+    if not args.interfere_scp:
+        print("[ERROR] --interfere-scp is required", file=sys.stderr); sys.exit(1)
     interfere_pairs = utils.read_scp(args.interfere_scp)
     if not interfere_pairs:
         print("[ERROR] speaker data is empty or error ,please check。", file=sys.stderr); sys.exit(1)
@@ -292,109 +811,124 @@ def main():
     bg_pairs = utils.read_scp(args.bg_scp) if args.bg_scp else []
     rir_pairs = utils.read_scp(args.rir_scp) if args.rir_scp else []
     os.makedirs(out_dir, exist_ok=True)
-    vad_model = AutoModel(model="../SenseVoice/fsmn_vad", model_revision="v2.0.4", disable_update=True)
-    vad_lock = threading.Lock()
+    total = len(train_pairs)
+    num_workers = args.num_workers if args.num_workers > 0 else max(1, (os.cpu_count() or 4) - 1)
 
-    def run_vad(path):
-        with vad_lock:
-            res = vad_model.generate(input=path)
-        return res
+    if args.prepare_bank and not args.bank_dir:
+        print("[ERROR] --prepare-bank needs --bank-dir", file=sys.stderr); sys.exit(1)
+    bank_dir = args.bank_dir
+    bank_sr = args.bank_sr if args.bank_sr is not None else (16000 if bank_dir else 0)
+    # the process backend always reads banks; the thread backend only when asked to resample, so the
+    # two backends write identical audio for the same options
+    if bank_dir is None and (args.backend == "process" or bank_sr):
+        bank_dir = tempfile.mkdtemp(prefix="banks_", dir=str(out_dir))
+    # RIRs and their FFT kernels are cached even without banks
+    mix_utils = BankUtils(rir_cache_bytes=args.rir_cache_mb << 20)
+    if bank_dir is not None:
+        # interferer, background and RIR audio decoded once, every segment pick is a slice of a mapped blob
+        os.makedirs(bank_dir, exist_ok=True)
+        bank_prefix = os.path.join(bank_dir, "bank")
+        seg_bank = AudioBank.open(bank_prefix + "_seg", [p for _, p in interfere_pairs + bg_pairs],
+                                  lambda path: utils.load_segment_source(path, bank_sr), bank_sr)
+        rir_bank = AudioBank.open(bank_prefix + "_rir", [p for _, p in rir_pairs], utils.load_audio_mono)
+        print(f"[INFO] audio banks: {len(seg_bank)} interferer/background files ({seg_bank.blob.nbytes / 2**20:.1f} MB), "
+              f"{len(rir_bank)} RIR files ({rir_bank.blob.nbytes / 2**20:.1f} MB)", file=sys.stderr)
+        if args.prepare_bank:
+            if vad_cache is not None:
+                vad_cache.close()
+            return
+        mix_utils = BankUtils(seg_bank, rir_bank, args.rir_cache_mb << 20)
+
+    # finished (utt, copy, seed) outputs are reused on restart, unless the mixing settings changed
+    mix_params = {k: getattr(args, k) for k in (
+        "interfere_scp", "sir_min", "sir_max", "max_interferers", "overlap_min", "overlap_max", "bg_scp",
+        "snr_min", "snr_max", "bg_prob", "speed_prob", "speed_min", "speed_max", "filter_prob", "rir_scp",
+        "rir_prob", "rir_volume", "peak_margin")}
+    mix_params["bank_sr"] = bank_sr
+    manifest = Manifest(args.manifest or str(out_dir / "aug_manifest.sqlite"), params={"mix": mix_params})
+    mixer = None
+    pool = None
+    if args.backend == "process":
+        pool = ProcessPoolExecutor(max_workers=num_workers, mp_context=multiprocessing.get_context("fork"),
+                                   initializer=init_mix_worker,
+                                   initargs=(args, bank_prefix, interfere_pairs, bg_pairs, rir_pairs, wav_dir))
+        # fork every worker now, before the VAD threads start
+        pool.submit(int).result()
+    else:
+        mixer = Mixer(args, mix_utils, interfere_pairs, bg_pairs, rir_pairs, wav_dir)
+
+    vad = VadWorkers(make_vad_model, args.vad_workers, args.vad_batch, vad_cache)
 
     def process_one(idx, pair):
         t_utt, t_path = pair
 
         if t_utt not in text_map:
-            return []
-        
-        try:
-            speech, sr_t = utils.load_audio_mono(t_path)
-        except Exception as e:
-            print(f"[WARN] failed read wav:{t_utt} -> {t_path} ({e}), skip", file=sys.stderr)
-            return []
-       
-        L = len(speech)
-        if L <= 0:
-            print(f"[WARN] empty wav:{t_utt} -> {t_path}, skip .", file=sys.stderr)
-            return []
+            return [], []
         base_txt = text_map[t_utt]
-      
+        base_seed = int(args.seed + idx * 1315423911)
+        outs = []
+        todo = []
+        for c in range(args.copies):
+            suffix = f"_aug{c+1}" if args.copies > 1 else "_aug1"
+            done_path = manifest.done(t_utt, "mix", c, base_seed + c + 1)
+            if done_path is None:
+                todo.append(c)
+            else:
+                outs.append((f"{t_utt}{suffix}", done_path, base_txt))
+        if not todo:
+            return outs, []
+
+        # VAD runs in its own stage while this thread reads the audio
+        vad_fut = vad.submit(t_path)
+        loaded = None
+        if mixer is not None:
+            loaded = mixer.load(t_utt, t_path)
+            if loaded is None:
+                return outs, []
+
         try:
-            vad_res = run_vad(t_path)
-            raw_vad = vad_res[0].get("value", [])
+            raw_vad = vad_fut.result()
         except Exception as e:
             print(f"[WARN] VAD failed for {t_utt}: {e}", file=sys.stderr)
             raw_vad = []
-      
-        seg_samples = [seg_ms_to_samples(seg, sr_t, L) for seg in raw_vad]
-        if not seg_samples:
-            seg_samples = [(0, L)]
-        outs = []
-        base_seed = int(args.seed + idx * 1315423911)
-       
-        for c in range(args.copies):
-            mixed = speech.copy().astype(np.float32)
-            rng = np.random.default_rng(base_seed + c + 1)
-            for (start, end) in seg_samples:
-                if end - start <= 0:
-                    continue  
-                seg_view = mixed[start:end].copy()
-                
-                if bg_pairs and (rng.random() < args.bg_prob):
-                    bg_utt, bg_path = bg_pairs[int(rng.integers(0, len(bg_pairs)))]
-                    
-                    try:
-                        bg_seg = utils.load_random_segment(bg_path, end - start, sr_t, rng)
-                        snr_db = float(rng.uniform(args.snr_min, args.snr_max))
-                        seg_view = utils.mix_background_at_snr(seg_view, bg_seg, snr_db)
-                    except Exception as e:
-                        print(f"[WARN] failed read background noise: {bg_utt} -> {bg_path} ({e}), skip.", file=sys.stderr)
-                
-                try:
-                    interf_sum = utils.build_interference_sum(
-                        end - start, sr_t, interfere_pairs, rng,
-                        overlap_min=args.overlap_min, overlap_max=args.overlap_max,
-                        max_interferers=args.max_interferers, speed_prob=args.speed_prob,
-                        speed_min=args.speed_min, speed_max=args.speed_max,
-                        filter_prob=args.filter_prob, rir_prob=args.rir_prob, rir_list=rir_pairs,
-                        rir_volume=args.rir_volume
-                    )
-                    sir_db = float(rng.uniform(args.sir_min, args.sir_max))
-                    seg_view = utils.mix_interferers_at_sir(seg_view, interf_sum, sir_db)
-                
-                except Exception as e:
-                    print(f"[WARN] Failed to mix interferer for {t_utt}: {e}.", file=sys.stderr)
-                mixed[start:end] = seg_view
 
-            mixed = utils.peak_normalize(mixed, peak_margin=args.peak_margin)
+        if mixer is not None:
+            written = mixer.mix(t_utt, *loaded, raw_vad, todo, base_seed)
+        else:
+            # this thread only waits, a worker process loads, mixes and writes the copies
+            written = pool.submit(run_mix_worker, t_utt, t_path, raw_vad, todo, base_seed).result()
+        new_entries = []
+        for c, out_path in written:
             suffix = f"_aug{c+1}" if args.copies > 1 else "_aug1"
-            out_name = f"{t_utt}{suffix}.wav"
-            out_path = str(wav_dir / out_name)
+            outs.append((f"{t_utt}{suffix}", out_path, base_txt))
+            new_entries.append((t_utt, c, base_seed + c + 1, out_path))
+        return outs, new_entries
 
-            try:
-                sf.write(out_path, mixed, sr_t, subtype="PCM_16")
-            
-            except Exception as e:
-                print(f"[WARN] failed to write file:{out_path} ({e}), skip.", file=sys.stderr)
-                continue
-            
-            out_utt = f"{t_utt}{suffix}"
-            outs.append((out_utt, out_path, base_txt))
-        return outs
-
-    total = len(train_pairs)
-    num_workers = args.num_workers if args.num_workers > 0 else max(1, (os.cpu_count() or 4) - 1)
     results = []
-    
-    with ThreadPoolExecutor(max_workers=num_workers) as ex:
+    # with the process backend the threads mostly wait, keep enough of them to feed every worker
+    num_threads = num_workers if pool is None else 2 * num_workers
+    with ThreadPoolExecutor(max_workers=num_threads) as ex:
         futs = {ex.submit(process_one, i, pair): i for i, pair in enumerate(train_pairs)}
         done_count = 0
         for fut in as_completed(futs):
-            outs = fut.result()
+            outs, new_entries = fut.result()
             if outs:
                 results.extend(outs)
+            for t_utt, c, seed, out_path in new_entries:
+                manifest.add(t_utt, "mix", c, seed, out_path)
             done_count += 1
             if done_count % 20 == 0 or done_count == total:
+                manifest.flush()
                 print(f"[INFO] files processed: {done_count}/{total}", file=sys.stderr)
+    if pool is not None:
+        pool.shutdown()
+    if bank_dir is not None and not args.bank_dir:
+        shutil.rmtree(bank_dir, ignore_errors=True)
+    manifest.close()
+    vad.close()
+    if vad_cache is not None:
+        print(f"[INFO] VAD cache: {vad_cache.hits} hits, {vad_cache.misses} misses", file=sys.stderr)
+        vad_cache.close()
 
     with open(out_scp_path, "w", encoding="utf-8") as out_scp_fp, open(out_text_path, "w", encoding="utf-8") as out_text_fp:
         for out_utt, out_path, base_txt in results:
@@ -0,0 +1,346 @@
+# Author: zyw
+# Date: 2026-10-18
+# Description: comp_CER.py 性能基准, 生成合成 ref/hyp 语料, 分别统计分词, 对齐, 聚类, 报告各阶段的耗时, 吞吐和峰值内存, 并与保存的 JSON 基线比较;
+#              --check 在随机语料上检查 Tokenizer 与 characterize/split + normalize 的结果一致
+
+import os
+import io
+import sys
+import json
+import time
+import random
+import itertools
+import logging
+import argparse
+import platform
+import resource
+import multiprocessing
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import comp_CER
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s %(message)s')
+logger = logging.getLogger(__name__)
+
+# 语料: 句数, 每句 token 数范围, 中文/英文/数字 token 的比例
+CORPORA = {
+    'short': dict(utts=20000, min_len=2, max_len=10, mix=(1.0, 0.0, 0.0)),
+    '30s': dict(utts=2000, min_len=100, max_len=160, mix=(0.9, 0.07, 0.03)),
+    'longform': dict(utts=40, min_len=2000, max_len=4000, mix=(0.9, 0.07, 0.03)),
+    'mandarin': dict(utts=5000, min_len=10, max_len=40, mix=(1.0, 0.0, 0.0)),
+    'codeswitch': dict(utts=5000, min_len=10, max_len=40, mix=(0.65, 0.3, 0.05)),
+}
+STAGES = ('tokenize', 'align', 'cluster', 'report')
+# hyp 中每个 ref token 的替换, 删除, 插入概率
+ERROR_RATES = (0.05, 0.03, 0.02)
+# 比较基线时忽略耗时低于该值 (秒) 的阶段, 避免噪声误报
+MIN_SECONDS = 0.05
+
+
+def make_lexicon(rng, n_chars=3000, n_words=1000):
+    chars = [chr(cp) for cp in rng.sample(range(0x4e00, 0x9fa6), n_chars)]
+    syllables = ['ka', 'lo', 'mi', 'ten', 'gra', 'de', 'sun', 'pri', 'ot', 'web', 'cha', 'ry']
+    words = set()
+    while len(words) < n_words:
+        words.add(''.join(rng.choice(syllables) for _ in range(rng.randint(1, 3))))
+    # 按 1/rank 的权重抽样, 接近真实文本的词频分布
+    cum_weights = list(itertools.accumulate(1.0 / (rank + 1) for rank in range(n_chars)))
+    return chars, cum_weights, sorted(words)
+
+
+def make_token(rng, lexicon, mix):
+    chars, cum_weights, words = lexicon
+    r = rng.random()
+    if r < mix[0]:
+        return rng.choices(chars, cum_weights=cum_weights)[0]
+    if r < mix[0] + mix[1]:
+        return rng.choice(words)
+    return str(rng.randint(0, 999))
+
+
+def join_tokens(tokens):
+    # 中文字符直接相连, 英文单词和数字用空格隔开
+    parts = []
+    for token in tokens:
+        if parts and (token.isascii() or parts[-1].isascii()):
+            parts.append(' ')
+        parts.append(token)
+    return ''.join(parts)
+
+
+def make_corpus(name, scale=1.0, seed=0):
+    """ 返回 (ref_lines, hyp_lines), kaldi 格式 "utt_id text"
+    """
+    spec = CORPORA[name]
+    rng = random.Random('%s-%d' % (name, seed))
+    lexicon = make_lexicon(rng)
+    p_sub, p_del, p_ins = ERROR_RATES
+    ref_lines = []
+    hyp_lines = []
+    for idx in range(max(1, int(spec['utts'] * scale))):
+        length = rng.randint(spec['min_len'], spec['max_len'])
+        ref = [make_token(rng, lexicon, spec['mix']) for _ in range(length)]
+        hyp = []
+        for token in ref:
+            r = rng.random()
+            if r < p_sub:
+                hyp.append(make_token(rng, lexicon, spec['mix']))
+            elif r >= p_sub + p_del:
+                hyp.append(token)
+            if rng.random() < p_ins:
+                hyp.append(make_token(rng, lexicon, spec['mix']))
+        fid = '%s_%07d' % (name, idx)
+        ref_lines.append('%s %s\n' % (fid, join_tokens(ref)))
+        hyp_lines.append('%s %s\n' % (fid, join_tokens(hyp)))
+    return ref_lines, hyp_lines
+
+
+# --check 中额外混入的标签, 标点, 全角符号, 大小写和 emoji
+NOISE_TOKENS = ('<unk>', '<noise>', '[laugh]', 'Hello', 'hello', 'O\'Neil', 'e-mail', 'U.S.', '，', '。', '？',
+                '！', '、', '……', '（', '）', '【', '】', '℃', '±', '＋', 'ｘ', '2.5', '3,000', '%', '😀', '\u3000',
+                'ok<sil>ok', 'ＡＢＣ', 'Ⅲ', '½', '¥100', '♪', '\t')
+# --check 中使用的忽略词和拆分表
+CHECK_IGNORE = ('<UNK>', 'HELLO', '，')
+CHECK_SPLIT = {'OK': ['O', 'K'], 'E-MAIL': ['E', 'MAIL'], 'Hello': ['hel', 'lo']}
+
+
+def make_check_lines(scale=1.0, seed=0):
+    """ 各语料的 ref/hyp 行, 随机插入 NOISE_TOKENS
+    """
+    rng = random.Random('check-%d' % seed)
+    lines = []
+    for name in CORPORA:
+        ref_lines, hyp_lines = make_corpus(name, scale * 0.1, seed)
+        for line in ref_lines + hyp_lines:
+            fid, _, text = line.partition(' ')
+            parts = text.split(' ')
+            for _ in range(rng.randint(0, 4)):
+                parts.insert(rng.randint(0, len(parts)), rng.choice(NOISE_TOKENS))
+            sep = rng.choice((' ', '', '  '))
+            lines.append('%s %s\n' % (fid, sep.join(parts)))
+    lines += ['\n', '   \n', 'only_fid\n', '<b>fid</b> x\n']
+    return lines
+
+
+def legacy_tokenize(line, tochar, ignore_words, cs, split, remove_tag, vocab):
+    # comp_CER 主流程原来的逐行处理
+    tokens = comp_CER.characterize(line) if tochar else line.split()
+    if not tokens:
+        return None
+    return tokens[0], comp_CER.normalize(tokens[1:], ignore_words, cs, split, vocab, remove_tag)
+
+
+def check_tokenizer(lines, out=sys.stdout):
+    """ 在所有选项组合下比较 Tokenizer 和 legacy_tokenize, 返回不一致的组合数
+    """
+    failures = 0
+    for tochar, cs, remove_tag, ignore, use_split, use_vocab in itertools.product((False, True), repeat=6):
+        ignore_words = set(CHECK_IGNORE if ignore else ())
+        split = {k: list(v) for k, v in CHECK_SPLIT.items()} if use_split else None
+        if not cs:
+            # 与 comp_CER 主流程一致, 不区分大小写时忽略词和拆分表先转成大写
+            ignore_words = {w.upper() for w in ignore_words}
+            if split:
+                split = {k.upper(): [w.upper() for w in v] for k, v in split.items()}
+        legacy_vocab = comp_CER.Vocab() if use_vocab else None
+        tokenizer = comp_CER.Tokenizer(tochar, ignore_words, cs, split, remove_tag,
+                                       comp_CER.Vocab() if use_vocab else None)
+        for line in lines:
+            expected = legacy_tokenize(line, tochar, ignore_words, cs, split, remove_tag, legacy_vocab)
+            got = tokenizer(line)
+            if expected is not None and legacy_vocab is not None:
+                expected = expected[0], legacy_vocab.decode(expected[1])
+            if got is not None:
+                got = got[0], (tokenizer.vocab.decode(got[1]) if use_vocab else list(got[1]))
+            if got != expected:
+                failures += 1
+                out.write('MISMATCH char=%d cs=%d rt=%d ignore=%d split=%d vocab=%d\n  line: %r\n  expected: %r\n  got: %r\n'
+                          % (tochar, cs, remove_tag, ignore, use_split, use_vocab, line, expected, got))
+                break
+    return failures
+
+
+def run_stages(ref_lines, hyp_lines, tochar=True, band=True, timer=None):
+    """ 依次运行四个阶段, timer(stage) 是每个阶段的上下文管理器
+    """
+    comp_CER.default_cluster.cache_clear()
+    vocab = comp_CER.Vocab()
+    tokenizer = comp_CER.Tokenizer(tochar, vocab=vocab)
+
+    with timer('tokenize'):
+        refs = [utt for utt in map(tokenizer, ref_lines) if utt is not None]
+        hyps = dict(utt for utt in map(tokenizer, hyp_lines) if utt is not None)
+
+    calculator = comp_CER.Calculator(vocab)
+    calculator.band = band
+    with timer('align'):
+        results = [(fid, calculator.calculate(lab, hyps[fid])) for fid, lab in refs]
+
+    with timer('cluster'):
+        default_words = {}
+        default_clusters = {}
+        for fid, lab in refs:
+            comp_CER.add_default_clusters(hyps[fid] + lab, vocab, default_words,
+                                          default_clusters)
+        clusters = [(name, calculator.cluster(words))
+                    for name, words in default_clusters.items()]
+
+    with timer('report'):
+        report = comp_CER.TextReport(io.StringIO())
+        for fid, result in results:
+            report.utterance(fid, result)
+        report.begin_summary()
+        report.overall(calculator.overall())
+        for name, result in clusters:
+            report.cluster(name, result)
+        report.end()
+
+    return sum(len(lab) for _, lab in refs)
+
+
+def peak_rss_mb():
+    # linux 上 ru_maxrss 的单位是 KB
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+class StageTimer:
+    """ 记录每个阶段的耗时, 以及该阶段结束时的进程峰值内存
+    """
+
+    def __init__(self):
+        self.seconds = {}
+        self.peak_mb = {}
+        self.stage = None
+
+    def __call__(self, stage):
+        self.stage = stage
+        return self
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc):
+        self.seconds[self.stage] = time.perf_counter() - self.start
+        self.peak_mb[self.stage] = max(self.peak_mb.get(self.stage, 0), peak_rss_mb())
+
+
+def bench_corpus(name, scale, seed, repeat, tochar, band):
+    ref_lines, hyp_lines = make_corpus(name, scale, seed)
+    best = {}
+    tokens = 0
+    timer = StageTimer()
+    for _ in range(repeat):
+        tokens = run_stages(ref_lines, hyp_lines, tochar, band, timer)
+        for stage, seconds in timer.seconds.items():
+            best[stage] = min(best.get(stage, seconds), seconds)
+    peak_mb = timer.peak_mb
+    utts = len(ref_lines)
+    stages = {}
+    for stage in STAGES:
+        seconds = best[stage]
+        stages[stage] = {
+            'seconds': round(seconds, 6),
+            'utts_per_s': round(utts / seconds, 1) if seconds > 0 else None,
+            'tokens_per_s': round(tokens / seconds, 1) if seconds > 0 else None,
+            'peak_mb': round(peak_mb[stage], 2),
+        }
+    return {'utts': utts, 'tokens': tokens, 'stages': stages}
+
+
+def print_results(results, out=sys.stdout):
+    header = ('corpus', 'stage', 'seconds', 'utts/s', 'tokens/s', 'peak MB')
+    out.write('%-11s %-9s %10s %12s %14s %8s\n' % header)
+    for name, result in results.items():
+        for stage, row in result['stages'].items():
+            out.write('%-11s %-9s %10.4f %12s %14s %8s\n' % (
+                name, stage, row['seconds'],
+                '-' if row['utts_per_s'] is None else '%.1f' % row['utts_per_s'],
+                '-' if row['tokens_per_s'] is None else '%.1f' % row['tokens_per_s'],
+                '%.2f' % row['peak_mb']))
+
+
+def compare(results, baseline, tolerance, out=sys.stdout):
+    """ 与基线比较耗时, 返回变慢超过 tolerance 的 (corpus, stage) 列表
+    """
+    regressions = []
+    out.write('%-11s %-9s %10s %10s %8s\n' % ('corpus', 'stage', 'baseline', 'current', 'ratio'))
+    for name, result in results.items():
+        if name not in baseline['results']:
+            continue
+        old_stages = baseline['results'][name]['stages']
+        for stage, row in result['stages'].items():
+            if stage not in old_stages:
+                continue
+            old = old_stages[stage]['seconds']
+            new = row['seconds']
+            ratio = new / old if old > 0 else float('inf')
+            flag = ''
+            if ratio > 1 + tolerance and max(old, new) >= MIN_SECONDS:
+                flag = '  REGRESSION'
+                regressions.append((name, stage))
+            out.write('%-11s %-9s %10.4f %10.4f %8.2f%s\n' % (name, stage, old, new, ratio, flag))
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="comp_CER.py 性能基准, 可保存 JSON 基线并与之比较")
+    parser.add_argument('--corpora', nargs='+', default=list(CORPORA), choices=list(CORPORA),
+                        help='要测试的语料, 默认全部')
+    parser.add_argument('--scale', type=float, default=1.0, help='语料句数的缩放系数, 默认为1')
+    parser.add_argument('--seed', type=int, default=0, help='生成语料的随机种子')
+    parser.add_argument('--repeat', type=int, default=3, help='每个语料重复次数, 取最快的一次')
+    parser.add_argument('--char', type=int, default=1, help='是否按字切分 (CER), 默认为1')
+    parser.add_argument('--band', type=int, default=1, help='是否使用带状对齐, 默认为1')
+    parser.add_argument('--save', help='把结果保存为 JSON 基线')
+    parser.add_argument('--compare', help='与该 JSON 基线比较, 有变慢的阶段时返回 1')
+    parser.add_argument('--tolerance', type=float, default=0.1, help='允许变慢的比例, 默认为0.1')
+    parser.add_argument('--check', action='store_true',
+                        help='只检查 Tokenizer 与 characterize/split + normalize 在随机语料和所有选项组合下结果一致, 不一致时返回 1')
+    args = parser.parse_args()
+
+    if args.check:
+        lines = make_check_lines(args.scale, args.seed)
+        logger.info(f"检查 Tokenizer, {len(lines)} 行, 64 种选项组合")
+        failures = check_tokenizer(lines)
+        if failures:
+            logger.warning(f"{failures} 种选项组合的结果不一致")
+            sys.exit(1)
+        logger.info("Tokenizer 与 characterize/split + normalize 结果一致")
+        sys.exit(0)
+
+    results = {}
+    for name in args.corpora:
+        logger.info(f"测试语料 {name}")
+        # 每个语料在新的子进程中运行, 峰值内存互不影响
+        with multiprocessing.get_context('fork').Pool(1) as pool:
+            results[name] = pool.apply(bench_corpus, (name, args.scale, args.seed, args.repeat,
+                                                      bool(args.char), bool(args.band)))
+    print_results(results)
+
+    if args.save:
+        data = {
+            'meta': {
+                'python': platform.python_version(),
+                'machine': platform.machine(),
+                'scale': args.scale,
+                'seed': args.seed,
+                'char': args.char,
+                'band': args.band,
+                'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+            },
+            'results': results,
+        }
+        with open(args.save, 'w', encoding='utf-8') as f:
+            json.dump(data, f, ensure_ascii=False, indent=2)
+        logger.info(f"基线已保存到 {args.save}")
+
+    if args.compare:
+        with open(args.compare, 'r', encoding='utf-8') as f:
+            baseline = json.load(f)
+        for key in ('scale', 'seed', 'char', 'band'):
+            if baseline['meta'].get(key) != getattr(args, key):
+                logger.warning(f"基线的 {key}={baseline['meta'].get(key)} 与本次 {getattr(args, key)} 不同")
+        regressions = compare(results, baseline, args.tolerance)
+        if regressions:
+            logger.warning(f"{len(regressions)} 个阶段比基线慢超过 {args.tolerance:.0%}")
+            sys.exit(1)
@@ -9,16 +9,35 @@ import argparse
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
-def check_data_consistency(wav_scp_lines, text_lines, data_list_lines):
-    if len(wav_scp_lines) != len(text_lines) or len(wav_scp_lines) != len(data_list_lines):
+def check_line_counts(wav_scp_count, text_count, data_list_count):
+    if wav_scp_count != text_count or wav_scp_count != data_list_count:
         logging.warning("============================================================")
         logging.warning("警告: wav.scp, text, data.list 文件的行数不一致,请检查输入文件。")
-        logging.warning("wav.scp 行数: %d", len(wav_scp_lines))
-        logging.warning("text 行数: %d", len(text_lines))
-        logging.warning("data.list 行数: %d", len(data_list_lines))
+        logging.warning("wav.scp 行数: %d", wav_scp_count)
+        logging.warning("text 行数: %d", text_count)
+        logging.warning("data.list 行数: %d", data_list_count)
         logging.warning("============================================================")
-    else:
-        logging.info("数据一致性检查通过")
+        return False
+    logging.info("数据一致性检查通过")
+    return True
+
+def check_data_consistency(wav_scp_lines, text_lines, data_list_lines):
+    return check_line_counts(len(wav_scp_lines), len(text_lines), len(data_list_lines))
+
+def count_lines(path, block_size=1 << 20):
+    # 按块统计行数, 与 readlines() 的行数一致, 但不把文件读进内存
+    count = 0
+    last = b'\n'
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            count += block.count(b'\n')
+            last = block[-1:]
+    if last != b'\n':
+        count += 1
+    return count
+
+def check_file_consistency(wav_scp_path, text_path, data_list_path):
+    return check_line_counts(count_lines(wav_scp_path), count_lines(text_path), count_lines(data_list_path))
 
 
 if __name__ == '__main__':
@@ -32,10 +51,6 @@ if __name__ == '__main__':
     text_path = os.path.join(args.input_dir, 'text')
     data_list_path = os.path.join(args.input_dir, 'data.list')
 
-    with open(wav_scp_path, 'r') as wav_scp_file, open(text_path, 'r') as text_file, open(data_list_path, 'r') as data_list_file:
-        wav_scp_lines = wav_scp_file.readlines()
-        text_lines = text_file.readlines()
-        data_list_lines = data_list_file.readlines()
-        check_data_consistency(wav_scp_lines, text_lines, data_list_lines)
+    check_file_consistency(wav_scp_path, text_path, data_list_path)
     logging.info('check done !')
 
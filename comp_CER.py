@@ -1,71 +1,148 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
+import os
 import sys
 import unicodedata
 import codecs
+import json
+import multiprocessing
+import queue
+import heapq
+import bisect
+import functools
+import hashlib
+import sqlite3
+import re
+import tempfile
+import itertools
+from array import array
+from collections import Counter
 
-remove_tag = True
 spacelist = [' ', '\t', '\r', '\n']
 puncts = [
     '!', ',', '?', '、', '。', '！', '，', '；', '？', '：', '「', '」', '︰', '『', '』',
     '《', '》'
 ]
+# characterize: ascii tokens and single non-ascii characters, and the
+# ascii run that follows a non-ascii symbol; tags for stripoff_tags
+CHAR_TOKEN_RE = re.compile(r'<[^\x80-\U0010ffff\t\n\r >]*>?'
+                           r'|[^\x80-\U0010ffff\t\n\r !,?][^\x80-\U0010ffff\t\n\r ]*'
+                           r'|[^\x00-\x7f]')
+ASCII_RUN_RE = re.compile(r'[^\x80-\U0010ffff\t\n\r ]*')
+TAG_RE = re.compile(r'<[^>]*>?')
+CHAR_SKIP, CHAR_ALONE, CHAR_RUN = range(3)
+char_kinds = {}
+# distinct tokens remembered by a Tokenizer, only tokens up to
+# TOKENIZER_CACHE_TOKEN_LEN characters: longer ones (a whole unspaced
+# Chinese sentence with --char=0) rarely repeat and would make the cache
+# grow with the input
+TOKENIZER_CACHE_SIZE = 1 << 20
+TOKENIZER_CACHE_TOKEN_LEN = 16
+# backpointer codes of the alignment trace
+OP_NON, OP_COR, OP_SUB, OP_DEL, OP_INS = range(5)
+OP_NAMES = ('non', 'cor', 'sub', 'del', 'ins')
+# banded alignment: smallest table worth banding, minimal half width and
+# the distance of the cells outside the band
+BAND_MIN_CELLS = 4096
+BAND_MIN_WIDTH = 8
+BAND_INF = 1 << 30
+# resampled utterance indices held at once by the bootstrap
+BOOTSTRAP_BATCH_CELLS = 1 << 24
+# default cluster codes of single characters
+(CLUSTER_UNNAMED, CLUSTER_NUMBER, CLUSTER_MANDARIN, CLUSTER_ENGLISH,
+ CLUSTER_JAPANESE, CLUSTER_IGNORED, CLUSTER_OTHER) = range(7)
+CLUSTER_NAMES = (None, 'Number', 'Mandarin', 'English', 'Japanese', None,
+                 'Other')
+# alignment cache: format version, default size cap and the estimated
+# sqlite overhead of one row
+CACHE_VERSION = 'ops-v1'
+CACHE_MAX_BYTES = 1 << 30
+CACHE_ROW_OVERHEAD = 32
+# lines per in-memory run of the external sort
+SORT_CHUNK_LINES = 1000000
+# utterance error rate percentiles and histogram bin edges (%)
+UTT_PERCENTILES = (50, 90, 95, 99)
+UTT_HISTOGRAM_EDGES = (0, 5, 10, 20, 30, 50, 100)
 
 
-def characterize(string):
-    res = []
-    i = 0
-    while i < len(string):
-        char = string[i]
-        if char in puncts:
-            i += 1
-            continue
+def char_kind(char):
+    """ how characterize treats a non-ascii character
+    """
+    kind = char_kinds.get(char)
+    if kind is None:
         cat1 = unicodedata.category(char)
         # https://unicodebook.readthedocs.io/unicode.html#unicode-categories
-        if cat1 == 'Zs' or cat1 == 'Cn' or char in spacelist:  # space or not assigned
-            i += 1
-            continue
-        if cat1 == 'Lo':  # letter-other
-            res.append(char)
-            i += 1
+        if char in puncts or cat1 == 'Zs' or cat1 == 'Cn':
+            kind = CHAR_SKIP  # punctuation, space or not assigned
+        elif cat1 == 'Lo':  # letter-other
+            kind = CHAR_ALONE
         else:
-            # some input looks like: <unk><noise>, we want to separate it to two words.
-            sep = ' '
-            if char == '<':
-                sep = '>'
-            j = i + 1
-            while j < len(string):
-                c = string[j]
-                if ord(c) >= 128 or (c in spacelist) or (c == sep):
-                    break
-                j += 1
-            if j < len(string) and string[j] == '>':
-                j += 1
-            res.append(string[i:j])
-            i = j
+            kind = CHAR_RUN
+        char_kinds[char] = kind
+    return kind
+
+
+def characterize(string):
+    res = []
+    pos = 0
+    search = CHAR_TOKEN_RE.search
+    while True:
+        m = search(string, pos)
+        if m is None:
+            break
+        token = m.group()
+        pos = m.end()
+        if token >= '\x80':
+            kind = char_kind(token)
+            if kind == CHAR_SKIP:
+                continue
+            if kind == CHAR_RUN:
+                # a non-ascii symbol runs on over the following ascii
+                pos = ASCII_RUN_RE.match(string, pos).end()
+                token = string[m.start():pos]
+        res.append(token)
     return res
 
 
 def stripoff_tags(x):
     if not x:
         return ''
-    chars = []
-    i = 0
-    T = len(x)
-    while i < T:
-        if x[i] == '<':
-            while i < T and x[i] != '>':
-                i += 1
-            i += 1
-        else:
-            chars.append(x[i])
-            i += 1
-    return ''.join(chars)
+    return TAG_RE.sub('', x)
+
+
+class Vocab:
+    """ interns tokens as compact integer ids, id 0 is the empty token
+    """
 
+    def __init__(self, tokens=None):
+        self.tokens = list(tokens) if tokens else ['']
+        self.ids = {token: idx for idx, token in enumerate(self.tokens)}
 
-def normalize(sentence, ignore_words, cs, split=None):
-    """ sentence, ignore_words are both in unicode
+    def __len__(self):
+        return len(self.tokens)
+
+    def intern(self, token):
+        idx = self.ids.get(token)
+        if idx is None:
+            idx = len(self.tokens)
+            self.ids[token] = idx
+            self.tokens.append(token)
+        return idx
+
+    def encode(self, tokens):
+        intern = self.intern
+        return array('i', [intern(token) for token in tokens])
+
+    def decode(self, ids):
+        tokens = self.tokens
+        return [tokens[idx] for idx in ids]
+
+
+def normalize(sentence, ignore_words, cs, split=None, vocab=None,
+              remove_tag=True):
+    """ sentence, ignore_words are both in unicode,
+        with a vocab the tokens come back as an int32 array of ids
     """
     new_sentence = []
     for token in sentence:
@@ -85,210 +162,1533 @@ def normalize(sentence, ignore_words, cs, split=None):
                 new_sentence.append(k)
         else:
             new_sentence.append(x)
+    if vocab is not None:
+        return vocab.encode(new_sentence)
     return new_sentence
 
 
+class Tokenizer:
+    """ turns the text of a line into normalized tokens, the same token
+        stream as characterize (or split) followed by normalize, with
+        the normalization of every distinct token computed once
+    """
+
+    def __init__(self, tochar=False, ignore_words=(), cs=False, split=None,
+                 remove_tag=True, vocab=None):
+        self.tochar = tochar
+        self.ignore_words = ignore_words
+        self.cs = cs
+        self.split = split
+        self.remove_tag = remove_tag
+        self.vocab = vocab
+        self.cache = {}
+
+    def tokens(self, line):
+        if self.tochar:
+            return characterize(line)
+        return line.split()
+
+    def expand(self, token):
+        x = token
+        if not self.cs:
+            x = x.upper()
+        if x in self.ignore_words:
+            return ()
+        if self.remove_tag:
+            x = stripoff_tags(x)
+        if not x:
+            return ()
+        new_tokens = []
+        if self.split and x in self.split:
+            new_tokens += self.split[x]
+        if x.isalnum():
+            new_tokens.extend(x)
+        else:
+            new_tokens.append(x)
+        if self.vocab is not None:
+            return tuple(self.vocab.encode(new_tokens))
+        return tuple(new_tokens)
+
+    def normalize(self, sentence):
+        cache = self.cache
+        new_sentence = [] if self.vocab is None else array('i')
+        for token in sentence:
+            expanded = cache.get(token)
+            if expanded is None:
+                expanded = self.expand(token)
+                if (len(token) <= TOKENIZER_CACHE_TOKEN_LEN
+                        and len(cache) < TOKENIZER_CACHE_SIZE):
+                    cache[token] = expanded
+            new_sentence.extend(expanded)
+        return new_sentence
+
+    def __call__(self, line):
+        """ returns (fid, tokens), or None for an empty line
+        """
+        tokens = self.tokens(line)
+        if len(tokens) == 0:
+            return None
+        return tokens[0], self.normalize(tokens[1:])
+
+
 class Calculator:
 
-    def __init__(self):
-        self.data = {}
-        self.space = []
+    def __init__(self, vocab=None):
+        self.vocab = vocab if vocab is not None else Vocab()
+        # per-token counters, indexed by token id
+        self.data = {
+            name: array('q')
+            for name in ('all', 'cor', 'sub', 'ins', 'del')
+        }
+        # substitution counts keyed by ref_id << 32 | hyp_id
+        self.confusions = Counter()
+        # distance rows and backpointer table, reused across calls
+        self.rows = (array('i'), array('i'))
+        self.trace = bytearray()
         self.cost = {}
         self.cost['cor'] = 0
         self.cost['sub'] = 1
         self.cost['del'] = 1
         self.cost['ins'] = 1
+        # use the banded alignment on long utterances
+        self.band = True
 
-    def calculate(self, lab, rec):
-        # Initialization
-        lab.insert(0, '')
-        rec.insert(0, '')
-        while len(self.space) < len(lab):
-            self.space.append([])
-        for row in self.space:
-            for element in row:
-                element['dist'] = 0
-                element['error'] = 'non'
-            while len(row) < len(rec):
-                row.append({'dist': 0, 'error': 'non'})
-        for i in range(len(lab)):
-            self.space[i][0]['dist'] = i
-            self.space[i][0]['error'] = 'del'
-        for j in range(len(rec)):
-            self.space[0][j]['dist'] = j
-            self.space[0][j]['error'] = 'ins'
-        self.space[0][0]['error'] = 'non'
-        for token in lab:
-            if token not in self.data and len(token) > 0:
-                self.data[token] = {
-                    'all': 0,
-                    'cor': 0,
-                    'sub': 0,
-                    'ins': 0,
-                    'del': 0
-                }
-        for token in rec:
-            if token not in self.data and len(token) > 0:
-                self.data[token] = {
-                    'all': 0,
-                    'cor': 0,
-                    'sub': 0,
-                    'ins': 0,
-                    'del': 0
-                }
-        # Computing edit distance
-        for i, lab_token in enumerate(lab):
-            for j, rec_token in enumerate(rec):
-                if i == 0 or j == 0:
-                    continue
-                min_dist = sys.maxsize
-                min_error = 'none'
-                dist = self.space[i - 1][j]['dist'] + self.cost['del']
-                error = 'del'
+    def reserve(self, n_rows, n_cols):
+        # distance rows carry one padding cell on each side for the band
+        for row in self.rows:
+            if len(row) < n_cols + 2:
+                row.extend([0] * (n_cols + 2 - len(row)))
+        size = n_rows * n_cols
+        if len(self.trace) < size:
+            self.trace.extend(bytes(size - len(self.trace)))
+
+    def align(self, lab, rec):
+        """ returns the edit operations (OP_COR, OP_SUB, OP_DEL, OP_INS)
+            turning lab into rec, in forward order
+        """
+        if self.band and len(lab) * len(rec) >= BAND_MIN_CELLS:
+            ops = self.align_banded(lab, rec)
+            if ops is not None:
+                return ops
+        return self.align_full(lab, rec)
+
+    def band_gap_cost(self):
+        """ lower bound of the cost of one step off the diagonal, 0 when
+            the costs do not allow banding
+        """
+        cost = self.cost
+        if min(cost['cor'], cost['sub']) < 0:
+            return 0
+        return max(0, min(1, cost['del'], cost['ins']))
+
+    def align_banded(self, lab, rec):
+        """ same alignment as align_full, computed only on the cells with
+            |i - j| <= k. Every cell outside the band costs at least
+            (k + 1) * gap, so once the banded distance is below that bound
+            no path through the outside can reach or tie any cell of the
+            traced path, and the backpointers along it (tie-breaking
+            included) are the ones of the full table. Returns None when
+            the band would grow too wide to pay off.
+        """
+        n = len(lab)
+        m = len(rec)
+        gap = self.band_gap_cost()
+        if gap <= 0:
+            return None
+        k = abs(n - m) + BAND_MIN_WIDTH
+        while 4 * k + 2 < m + 1:
+            dist = self.fill_band(lab, rec, k)
+            if dist < (k + 1) * gap:
+                break
+            # the band now holds a path as cheap as the optimal one;
+            # doubling keeps the refills within twice the last one
+            k = max(2 * k, int(dist // gap))
+        else:
+            return None
+        width = 2 * k + 1
+        trace = self.trace
+        ops = bytearray()
+        i = n
+        j = m
+        while True:
+            error = trace[i * width + j - i + k]
+            if error == OP_COR or error == OP_SUB:
+                i -= 1
+                j -= 1
+            elif error == OP_DEL:
+                i -= 1
+            elif error == OP_INS:
+                j -= 1
+            else:  # starting point
+                break
+            ops.append(error)
+        ops.reverse()
+        return bytes(ops)
+
+    def fill_band(self, lab, rec, k):
+        """ fills the backpointers of the band |i - j| <= k, stored row by
+            row at offset j - i + k, and returns the banded distance
+        """
+        n = len(lab)
+        m = len(rec)
+        width = 2 * k + 1
+        self.reserve(n + 1, width)
+        trace = self.trace
+        prev, cur = self.rows
+        c_cor = self.cost['cor']
+        c_sub = self.cost['sub']
+        c_del = self.cost['del']
+        c_ins = self.cost['ins']
+        # Initialization, row cell j sits at p = j - i + k + 1
+        for p in range(width + 2):
+            prev[p] = BAND_INF
+            cur[p] = BAND_INF
+        trace[k] = OP_NON
+        prev[k + 1] = 0
+        for j in range(1, min(m, k) + 1):
+            prev[j + k + 1] = j
+            trace[j + k] = OP_INS
+        # Computing edit distance, ties prefer del, then ins, then cor/sub
+        for i in range(1, n + 1):
+            lab_token = lab[i - 1]
+            base = i * width - i + k
+            j_lo = i - k
+            if j_lo <= 0:
+                j_lo = 1
+                trace[base] = OP_DEL
+                cur[k + 1 - i] = left = i
+            else:
+                # the band starts at p = 1, its left neighbour is p = 0
+                cur[0] = left = BAND_INF
+            j_hi = min(m, i + k)
+            p = j_lo - i + k + 1
+            diag = prev[p]
+            for j in range(j_lo, j_hi + 1):
+                up = prev[p + 1]
+                min_dist = up + c_del
+                min_error = OP_DEL
+                dist = left + c_ins
                 if dist < min_dist:
                     min_dist = dist
-                    min_error = error
-                dist = self.space[i][j - 1]['dist'] + self.cost['ins']
-                error = 'ins'
+                    min_error = OP_INS
+                if lab_token == rec[j - 1]:
+                    dist = diag + c_cor
+                    error = OP_COR
+                else:
+                    dist = diag + c_sub
+                    error = OP_SUB
                 if dist < min_dist:
                     min_dist = dist
                     min_error = error
-                if lab_token == rec_token:
-                    dist = self.space[i - 1][j - 1]['dist'] + self.cost['cor']
-                    error = 'cor'
+                cur[p] = left = min_dist
+                trace[base + j] = min_error
+                diag = up
+                p += 1
+            cur[p] = BAND_INF
+            prev, cur = cur, prev
+        return prev[m - n + k + 1]
+
+    def align_full(self, lab, rec):
+        """ fills the whole len(lab) x len(rec) table
+        """
+        n = len(lab)
+        m = len(rec)
+        cols = m + 1
+        self.reserve(n + 1, cols)
+        trace = self.trace
+        prev, cur = self.rows
+        c_cor = self.cost['cor']
+        c_sub = self.cost['sub']
+        c_del = self.cost['del']
+        c_ins = self.cost['ins']
+        # Initialization
+        trace[0] = OP_NON
+        prev[0] = 0
+        for j in range(1, cols):
+            prev[j] = j
+            trace[j] = OP_INS
+        # Computing edit distance, ties prefer del, then ins, then cor/sub
+        for i in range(1, n + 1):
+            lab_token = lab[i - 1]
+            base = i * cols
+            trace[base] = OP_DEL
+            cur[0] = left = i
+            diag = prev[0]
+            for j in range(1, cols):
+                up = prev[j]
+                min_dist = up + c_del
+                min_error = OP_DEL
+                dist = left + c_ins
+                if dist < min_dist:
+                    min_dist = dist
+                    min_error = OP_INS
+                if lab_token == rec[j - 1]:
+                    dist = diag + c_cor
+                    error = OP_COR
                 else:
-                    dist = self.space[i - 1][j - 1]['dist'] + self.cost['sub']
-                    error = 'sub'
+                    dist = diag + c_sub
+                    error = OP_SUB
                 if dist < min_dist:
                     min_dist = dist
                     min_error = error
-                self.space[i][j]['dist'] = min_dist
-                self.space[i][j]['error'] = min_error
+                cur[j] = left = min_dist
+                trace[base + j] = min_error
+                diag = up
+            prev, cur = cur, prev
         # Tracing back
+        ops = bytearray()
+        i = n
+        j = m
+        while True:
+            error = trace[i * cols + j]
+            if error == OP_COR or error == OP_SUB:
+                i -= 1
+                j -= 1
+            elif error == OP_DEL:
+                i -= 1
+            elif error == OP_INS:
+                j -= 1
+            else:  # starting point
+                break
+            ops.append(error)
+        ops.reverse()
+        return bytes(ops)
+
+    def encode(self, tokens):
+        if isinstance(tokens, array):
+            return tokens
+        return self.vocab.encode(tokens)
+
+    def calculate(self, lab, rec, ops=None, ids=False):
+        """ lab, rec are token lists or id arrays from the same vocab,
+            ops is a known alignment of them, like result['ops'] of an
+            earlier call; with ids the aligned result['lab'] and
+            result['rec'] are id arrays with 0 for a gap instead of
+            token lists with ''
+        """
+        lab = self.encode(lab)
+        rec = self.encode(rec)
+        data = self.data
+        grow = len(self.vocab) - len(data['all'])
+        if grow > 0:
+            for counter in data.values():
+                counter.frombytes(bytes(8 * grow))
+        tokens = self.vocab.tokens
+        gap = ''
+        if ids:
+            # tokens[token] is then the id itself
+            tokens = range(len(tokens))
+            gap = 0
+        if ops is None:
+            ops = self.align(lab, rec)
         result = {
-            'lab': [],
-            'rec': [],
+            'lab': array('i') if ids else [],
+            'rec': array('i') if ids else [],
+            'ops': ops,
             'all': 0,
             'cor': 0,
             'sub': 0,
             'ins': 0,
             'del': 0
         }
-        i = len(lab) - 1
-        j = len(rec) - 1
-        while True:
-            if self.space[i][j]['error'] == 'cor':  # correct
-                if len(lab[i]) > 0:
-                    self.data[lab[i]]['all'] = self.data[lab[i]]['all'] + 1
-                    self.data[lab[i]]['cor'] = self.data[lab[i]]['cor'] + 1
-                    result['all'] = result['all'] + 1
-                    result['cor'] = result['cor'] + 1
-                result['lab'].insert(0, lab[i])
-                result['rec'].insert(0, rec[j])
-                i = i - 1
-                j = j - 1
-            elif self.space[i][j]['error'] == 'sub':  # substitution
-                if len(lab[i]) > 0:
-                    self.data[lab[i]]['all'] = self.data[lab[i]]['all'] + 1
-                    self.data[lab[i]]['sub'] = self.data[lab[i]]['sub'] + 1
-                    result['all'] = result['all'] + 1
-                    result['sub'] = result['sub'] + 1
-                result['lab'].insert(0, lab[i])
-                result['rec'].insert(0, rec[j])
-                i = i - 1
-                j = j - 1
-            elif self.space[i][j]['error'] == 'del':  # deletion
-                if len(lab[i]) > 0:
-                    self.data[lab[i]]['all'] = self.data[lab[i]]['all'] + 1
-                    self.data[lab[i]]['del'] = self.data[lab[i]]['del'] + 1
-                    result['all'] = result['all'] + 1
-                    result['del'] = result['del'] + 1
-                result['lab'].insert(0, lab[i])
-                result['rec'].insert(0, "")
-                i = i - 1
-            elif self.space[i][j]['error'] == 'ins':  # insertion
-                if len(rec[j]) > 0:
-                    self.data[rec[j]]['ins'] = self.data[rec[j]]['ins'] + 1
-                    result['ins'] = result['ins'] + 1
-                result['lab'].insert(0, "")
-                result['rec'].insert(0, rec[j])
-                j = j - 1
-            elif self.space[i][j]['error'] == 'non':  # starting point
-                break
-            else:  # shouldn't reach here
-                print('this should not happen , i={i} , j={j} , \
-                      error={error}'.format(i=i,
-                                            j=j,
-                                            error=self.space[i][j]['error']))
+        result_lab = result['lab']
+        result_rec = result['rec']
+        data_all = data['all']
+        confusions = self.confusions
+        i = 0
+        j = 0
+        for error in ops:
+            if error == OP_INS:
+                token = rec[j]
+                if token:
+                    data['ins'][token] += 1
+                    result['ins'] += 1
+                result_lab.append(gap)
+                result_rec.append(tokens[token])
+                j += 1
+                continue
+            token = lab[i]
+            name = OP_NAMES[error]
+            if token:
+                data_all[token] += 1
+                data[name][token] += 1
+                result['all'] += 1
+                result[name] += 1
+            result_lab.append(tokens[token])
+            if error == OP_DEL:
+                result_rec.append(gap)
+            else:
+                if error == OP_SUB and token:
+                    confusions[token << 32 | rec[j]] += 1
+                result_rec.append(tokens[rec[j]])
+                j += 1
+            i += 1
         return result
 
     def overall(self):
-        result = {'all': 0, 'cor': 0, 'sub': 0, 'ins': 0, 'del': 0}
-        for token in self.data:
-            result['all'] = result['all'] + self.data[token]['all']
-            result['cor'] = result['cor'] + self.data[token]['cor']
-            result['sub'] = result['sub'] + self.data[token]['sub']
-            result['ins'] = result['ins'] + self.data[token]['ins']
-            result['del'] = result['del'] + self.data[token]['del']
-        return result
+        return {name: sum(counter) for name, counter in self.data.items()}
 
     def cluster(self, data):
+        """ data holds tokens or token ids
+        """
         result = {'all': 0, 'cor': 0, 'sub': 0, 'ins': 0, 'del': 0}
+        ids = self.vocab.ids
+        size = len(self.data['all'])
         for token in data:
-            if token in self.data:
-                result['all'] = result['all'] + self.data[token]['all']
-                result['cor'] = result['cor'] + self.data[token]['cor']
-                result['sub'] = result['sub'] + self.data[token]['sub']
-                result['ins'] = result['ins'] + self.data[token]['ins']
-                result['del'] = result['del'] + self.data[token]['del']
+            if not isinstance(token, int):
+                token = ids.get(token, 0)
+            if 0 < token < size:
+                for name in result:
+                    result[name] += self.data[name][token]
         return result
 
+    def top_confusions(self, k, data=None):
+        """ the k most frequent substitutions as (ref, hyp, count), only
+            those of ref tokens (or ids) in data when given
+        """
+        items = self.confusions.items()
+        if data is not None:
+            ids = self.vocab.ids
+            keep = set(token if isinstance(token, int) else ids.get(token, 0)
+                       for token in data)
+            items = [(key, count) for key, count in items
+                     if key >> 32 in keep]
+        # most frequent first, ties in id order
+        top = heapq.nsmallest(k, items, key=lambda item: (-item[1], item[0]))
+        tokens = self.vocab.tokens
+        return [(tokens[key >> 32], tokens[key & 0xffffffff], count)
+                for key, count in top]
+
+    def merge(self, data, confusions=None):
+        """ adds the per-token counters and the confusions of another
+            Calculator sharing the same vocab
+        """
+        if confusions:
+            self.confusions.update(confusions)
+        for name, counter in self.data.items():
+            other = data[name]
+            grow = len(other) - len(counter)
+            if grow > 0:
+                counter.frombytes(bytes(8 * grow))
+            for idx, value in enumerate(other):
+                if value:
+                    counter[idx] += value
+
     def keys(self):
-        return list(self.data.keys())
+        data = self.data
+        return [
+            self.vocab.tokens[idx] for idx in range(1, len(data['all']))
+            if data['all'][idx] or data['ins'][idx]
+        ]
+
+
+def read_utts(fh, tokenizer):
+    """ yields (fid, tokens) for every non-empty line of a kaldi style file
+    """
+    with fh:
+        for line in fh:
+            utt = tokenizer(line)
+            if utt is not None:
+                yield utt
+
+
+def dict_join(refs, rec_set, unmatched):
+    """ yields (fid, ref tokens, rec) for the refs found in rec_set and
+        counts the keys found in only one of them
+    """
+    matched = set()
+    for fid, tokens in refs:
+        if fid not in rec_set:
+            unmatched['ref'] += 1
+            continue
+        matched.add(fid)
+        yield fid, tokens, rec_set[fid]
+    unmatched['hyp'] += len(rec_set) - len(matched)
+
+
+def merge_join(refs, hyps, unmatched):
+    """ same as dict_join for ref and hyp streams sorted by key
+        (LC_ALL=C sort -k1,1), in constant memory. Like the dict, the last
+        of several hyps with the same key wins.
+    """
+    def ordered(utts, name):
+        last = None
+        for fid, tokens in utts:
+            if last is not None and fid < last:
+                raise ValueError('%s is not sorted by key: %s after %s' %
+                                 (name, fid, last))
+            last = fid
+            yield fid, tokens
+
+    def last_of_key(utts):
+        fid, tokens = None, None
+        for next_fid, next_tokens in utts:
+            if fid is not None and next_fid != fid:
+                yield fid, tokens
+            fid, tokens = next_fid, next_tokens
+        if fid is not None:
+            yield fid, tokens
+
+    hyps = last_of_key(ordered(hyps, 'hyp'))
+    hyp = next(hyps, None)
+    used = False
+    for fid, tokens in ordered(refs, 'ref'):
+        while hyp is not None and hyp[0] < fid:
+            if not used:
+                unmatched['hyp'] += 1
+            hyp = next(hyps, None)
+            used = False
+        if hyp is None or hyp[0] != fid:
+            unmatched['ref'] += 1
+            continue
+        used = True
+        yield fid, tokens, hyp[1]
+    while hyp is not None:
+        if not used:
+            unmatched['hyp'] += 1
+        hyp = next(hyps, None)
+        used = False
+
+
+def sort_key(line):
+    fields = line.split(None, 1)
+    return fields[0] if fields else b''
+
+
+def sort_by_key(path, tmp_dir, chunk_lines=SORT_CHUNK_LINES):
+    """ sorts a kaldi style file by key like LC_ALL=C sort -s -k1,1,
+        holding at most chunk_lines lines in memory, and returns the path
+        of the sorted copy in tmp_dir
+    """
+    runs = []
+
+    def flush(lines):
+        lines.sort(key=sort_key)
+        fd, run = tempfile.mkstemp(dir=tmp_dir, suffix='.run')
+        with os.fdopen(fd, 'wb') as fo:
+            fo.writelines(lines)
+        runs.append(run)
+
+    lines = []
+    with open(path, 'rb') as fh:
+        for line in fh:
+            if not line.endswith(b'\n'):
+                line += b'\n'
+            lines.append(line)
+            if len(lines) >= chunk_lines:
+                flush(lines)
+                lines = []
+    if lines or not runs:
+        flush(lines)
+    if len(runs) == 1:
+        return runs[0]
+    fd, out = tempfile.mkstemp(dir=tmp_dir, suffix='.sorted')
+    fhs = [open(run, 'rb') for run in runs]
+    with os.fdopen(fd, 'wb') as fo:
+        fo.writelines(heapq.merge(*fhs, key=sort_key))
+    for fh, run in zip(fhs, runs):
+        fh.close()
+        os.remove(run)
+    return out
+
+
+class AlignmentCache:
+    """ alignments of (ref tokens, hyp tokens) pairs kept in an sqlite file
+        across runs, the least recently used ones are evicted once the
+        file holds more than max_bytes of them
+    """
+
+    def __init__(self, path, max_bytes=CACHE_MAX_BYTES, options='',
+                 deferred=False):
+        # kept to open the same cache in the score_systems workers
+        self.args = (path, max_bytes, options)
+        self.db = sqlite3.connect(path, timeout=60)
+        self.db.execute('CREATE TABLE IF NOT EXISTS align '
+                        '(key BLOB PRIMARY KEY, ops BLOB NOT NULL, '
+                        'used INTEGER NOT NULL)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS align_used '
+                        'ON align (used)')
+        self.clock = self.db.execute(
+            'SELECT COALESCE(MAX(used), 0) FROM align').fetchone()[0]
+        self.max_bytes = max_bytes
+        self.options = (CACHE_VERSION + '\x00' + options).encode('utf-8')
+        self.hits = 0
+        self.misses = 0
+        # a deferred cache only reads the file and records its updates,
+        # (key, None) for a hit and (key, ops) for a new alignment, for
+        # the process owning the file to replay with apply()
+        self.updates = [] if deferred else None
+
+    def key(self, lab, rec):
+        """ lab, rec are the normalized token strings
+        """
+        digest = hashlib.blake2b(self.options, digest_size=16)
+        digest.update('\x00'.join(lab).encode('utf-8'))
+        digest.update(b'\x00\x01\x00')
+        digest.update('\x00'.join(rec).encode('utf-8'))
+        return digest.digest()
+
+    def get(self, key):
+        row = self.db.execute('SELECT ops FROM align WHERE key = ?',
+                              (key, )).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        if self.updates is not None:
+            self.updates.append((key, None))
+        else:
+            self.touch(key)
+        return bytes(row[0])
+
+    def touch(self, key):
+        self.clock += 1
+        self.db.execute('UPDATE align SET used = ? WHERE key = ?',
+                        (self.clock, key))
+
+    def put(self, key, ops):
+        if self.updates is not None:
+            self.updates.append((key, ops))
+            return
+        self.clock += 1
+        self.db.execute('INSERT OR REPLACE INTO align VALUES (?, ?, ?)',
+                        (key, ops, self.clock))
+
+    def apply(self, updates, hits, misses):
+        """ replays the updates and counts of a deferred cache
+        """
+        for key, ops in updates:
+            if ops is None:
+                self.touch(key)
+            else:
+                self.put(key, ops)
+        self.hits += hits
+        self.misses += misses
+
+    def evict(self):
+        total = 0
+        rows = self.db.execute('SELECT used, LENGTH(key) + LENGTH(ops) '
+                               'FROM align ORDER BY used DESC')
+        for used, size in rows:
+            total += size + CACHE_ROW_OVERHEAD
+            if total > self.max_bytes:
+                self.db.execute('DELETE FROM align WHERE used <= ?', (used, ))
+                break
+
+    def close(self):
+        self.evict()
+        self.db.commit()
+        self.db.close()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        rate = self.hits * 100.0 / lookups if lookups else 0.0
+        return ('alignment cache: %d hits, %d misses, hit rate %4.2f %%' %
+                (self.hits, self.misses, rate))
+
+
+def score_worker(band, keep_alignment, tasks, results):
+    calculator = Calculator(Vocab())
+    calculator.band = band
+    intern = calculator.vocab.intern
+    for seq, new_tokens, chunk in iter(tasks.get, None):
+        # tokens interned by the main process since this worker's last chunk
+        for token in new_tokens:
+            intern(token)
+        out = []
+        for lab, rec, ops in chunk:
+            result = calculator.calculate(lab, rec, ops)
+            if not keep_alignment:
+                del result['lab'], result['rec']
+            out.append(result)
+        results.put((seq, out))
+    results.put((None, (calculator.data, calculator.confusions)))
+
+
+def score_parallel(utts, calculator, jobs, keep_alignment=True,
+                   chunk_size=64, window=None):
+    """ aligns (fid, lab, rec, ops, ...) utterances on jobs worker
+        processes, merges the per-token counters of every worker into
+        calculator at the end and yields (utterance, result) in the input
+        order; utts is read lazily with at most window chunks in flight,
+        4 per worker by default, so a streamed join keeps its memory bound
+    """
+    vocab = calculator.vocab
+    # one task queue per worker, each chunk carries the tokens that
+    # worker has not been sent yet
+    tasks = [multiprocessing.Queue() for _ in range(jobs)]
+    results = multiprocessing.Queue()
+    workers = [
+        multiprocessing.Process(target=score_worker,
+                                args=(calculator.band, keep_alignment,
+                                      tasks[k], results),
+                                daemon=True) for k in range(jobs)
+    ]
+    for worker in workers:
+        worker.start()
+    window = window or 4 * jobs
+    utts = iter(utts)
+    sent = [1] * jobs  # id 0, the empty token, is in every Vocab
+    chunks = {}
+    pending = {}
+    next_seq = 0
+    seq = 0
+    exhausted = False
+    while True:
+        while not exhausted and len(chunks) < window:
+            chunk = list(itertools.islice(utts, chunk_size))
+            if not chunk:
+                exhausted = True
+                break
+            k = seq % jobs
+            tasks[k].put((seq, vocab.tokens[sent[k]:],
+                          [utt[1:4] for utt in chunk]))
+            sent[k] = len(vocab)
+            chunks[seq] = chunk
+            seq += 1
+        if not chunks:
+            break
+        try:
+            done_seq, out = results.get(timeout=1)
+        except queue.Empty:
+            if any(worker.exitcode for worker in workers):
+                raise RuntimeError('a scoring worker died')
+            continue
+        pending[done_seq] = out
+        while next_seq in pending:
+            for utt, result in zip(chunks.pop(next_seq),
+                                   pending.pop(next_seq)):
+                yield utt, result
+            next_seq += 1
+    for task_queue in tasks:
+        task_queue.put(None)
+    finished = 0
+    while finished < jobs:
+        try:
+            _, out = results.get(timeout=1)
+        except queue.Empty:
+            if any(worker.exitcode for worker in workers):
+                raise RuntimeError('a scoring worker died')
+            continue
+        calculator.merge(*out)
+        finished += 1
+    for worker in workers:
+        worker.join()
 
 
 def width(string):
     return sum(1 + (unicodedata.east_asian_width(c) in "AFW") for c in string)
 
 
+def cluster_code(name):
+    """ maps a unicode character name to its default cluster code
+    """
+    if not name:
+        return CLUSTER_UNNAMED
+    if name.startswith('DIGIT'):  # 1
+        return CLUSTER_NUMBER
+    if name.startswith(('CJK UNIFIED IDEOGRAPH',
+                        'CJK COMPATIBILITY IDEOGRAPH')):  # 明 / 郎
+        return CLUSTER_MANDARIN
+    if name.startswith(('LATIN CAPITAL LETTER', 'LATIN SMALL LETTER')):
+        return CLUSTER_ENGLISH  # A / a
+    if name.startswith('HIRAGANA LETTER'):  # は こ め
+        return CLUSTER_JAPANESE
+    if name.startswith(('AMPERSAND', 'APOSTROPHE', 'COMMERCIAL AT',
+                        'DEGREE CELSIUS', 'EQUALS SIGN', 'FULL STOP',
+                        'HYPHEN-MINUS', 'LOW LINE', 'NUMBER SIGN',
+                        'PLUS SIGN', 'SEMICOLON')):
+        # & / ' / @ / ℃ / = / . / - / _ / # / + / ;
+        return CLUSTER_IGNORED
+    return CLUSTER_OTHER
+
+
+cluster_table = bytearray()
+
+
+def char_cluster_code(char):
+    cp = ord(char)
+    if cp < 0x10000:
+        if not cluster_table:
+            # one code per BMP codepoint, built on first use
+            cluster_table.extend(
+                cluster_code(unicodedata.name(chr(c), ''))
+                for c in range(0x10000))
+        return cluster_table[cp]
+    return cluster_code(unicodedata.name(char, ''))
+
+
+@functools.lru_cache(maxsize=1 << 16)
 def default_cluster(word):
-    unicode_names = [unicodedata.name(char) for char in word]
-    for i in reversed(range(len(unicode_names))):
-        if unicode_names[i].startswith('DIGIT'):  # 1
-            unicode_names[i] = 'Number'  # 'DIGIT'
-        elif (unicode_names[i].startswith('CJK UNIFIED IDEOGRAPH')
-              or unicode_names[i].startswith('CJK COMPATIBILITY IDEOGRAPH')):
-            # 明 / 郎
-            unicode_names[i] = 'Mandarin'  # 'CJK IDEOGRAPH'
-        elif (unicode_names[i].startswith('LATIN CAPITAL LETTER')
-              or unicode_names[i].startswith('LATIN SMALL LETTER')):
-            # A / a
-            unicode_names[i] = 'English'  # 'LATIN LETTER'
-        elif unicode_names[i].startswith('HIRAGANA LETTER'):  # は こ め
-            unicode_names[i] = 'Japanese'  # 'GANA LETTER'
-        elif (unicode_names[i].startswith('AMPERSAND')
-              or unicode_names[i].startswith('APOSTROPHE')
-              or unicode_names[i].startswith('COMMERCIAL AT')
-              or unicode_names[i].startswith('DEGREE CELSIUS')
-              or unicode_names[i].startswith('EQUALS SIGN')
-              or unicode_names[i].startswith('FULL STOP')
-              or unicode_names[i].startswith('HYPHEN-MINUS')
-              or unicode_names[i].startswith('LOW LINE')
-              or unicode_names[i].startswith('NUMBER SIGN')
-              or unicode_names[i].startswith('PLUS SIGN')
-              or unicode_names[i].startswith('SEMICOLON')):
-            # & / ' / @ / ℃ / = / . / - / _ / # / + / ;
-            del unicode_names[i]
-        else:
-            return 'Other'
-    if len(unicode_names) == 0:
+    codes = [char_cluster_code(char) for char in word]
+    if CLUSTER_UNNAMED in codes:
+        # same error as looking up the name of an unnamed character
+        unicodedata.name(word[codes.index(CLUSTER_UNNAMED)])
+    if CLUSTER_OTHER in codes:
+        return 'Other'
+    codes = [code for code in codes if code != CLUSTER_IGNORED]
+    if len(codes) == 0:
         return 'Other'
-    if len(unicode_names) == 1:
-        return unicode_names[0]
-    for i in range(len(unicode_names) - 1):
-        if unicode_names[i] != unicode_names[i + 1]:
+    for i in range(len(codes) - 1):
+        if codes[i] != codes[i + 1]:
             return 'Other'
-    return unicode_names[0]
+    return CLUSTER_NAMES[codes[0]]
+
+
+def add_default_clusters(words, vocab, default_words, default_clusters):
+    for word in words:
+        if word not in default_words:
+            default_cluster_name = default_cluster(vocab.tokens[word])
+            if default_cluster_name not in default_clusters:
+                default_clusters[default_cluster_name] = {}
+            if word not in default_clusters[default_cluster_name]:
+                default_clusters[default_cluster_name][word] = 1
+            default_words[word] = default_cluster_name
+
+
+class KeywordClusters:
+    """ the clusters of a --cluster file, blocks like
+
+            <Keyword> WEATHER CAR 天气 </Keyword>
+
+        parsed once, every entry normalized by the tokenizer. Entries of
+        a single token are counted from the per-token counters of the
+        calculator, longer ones (phrases) are matched on the ref side of
+        every alignment with a trie of token ids and counted per phrase,
+        so the cost of a match does not grow with the number of clusters
+    """
+    # trie key of the phrase id a path ends in
+    END = -1
+
+    def __init__(self, tokenizer):
+        self.tokenizer = tokenizer
+        self.names = []
+        # token id -> indices of the clusters it is an entry of
+        self.tokens = {}
+        self.trie = {}
+        # phrase id -> indices of its clusters, and per-phrase counters
+        self.phrases = []
+        self.data = {
+            name: array('q')
+            for name in ('all', 'cor', 'sub', 'ins', 'del')
+        }
+
+    def load(self, path):
+        cluster_id = ''
+        cluster = []
+        with open(path, 'r', encoding='utf-8') as fh:
+            for line in fh:
+                for token in line.split():
+                    # end of cluster reached, like </Keyword>
+                    if token[0:2] == '</' and token[len(token) - 1] == '>' and \
+                       token.lstrip('</').rstrip('>') == cluster_id:
+                        self.add(cluster_id, cluster)
+                        cluster_id = ''
+                        cluster = []
+                    # begin of cluster reached, like <Keyword>
+                    elif (token[0] == '<' and token[len(token) - 1] == '>'
+                          and cluster_id == ''):
+                        cluster_id = token.lstrip('<').rstrip('>')
+                        cluster = []
+                    # general terms, like WEATHER / CAR / ...
+                    else:
+                        cluster.append(token)
+        return self
+
+    def add(self, name, entries):
+        idx = len(self.names)
+        self.names.append(name)
+        seen = set()
+        for entry in entries:
+            ids = tuple(self.tokenizer.normalize(self.tokenizer.tokens(entry)))
+            if not ids or ids in seen:
+                continue
+            seen.add(ids)
+            if len(ids) == 1:
+                self.tokens.setdefault(ids[0], []).append(idx)
+                continue
+            node = self.trie
+            for token in ids:
+                node = node.setdefault(token, {})
+            phrase = node.get(self.END)
+            if phrase is None:
+                phrase = node[self.END] = len(self.phrases)
+                self.phrases.append([])
+                for counter in self.data.values():
+                    counter.append(0)
+            self.phrases[phrase].append(idx)
+
+    def count(self, lab, ops):
+        """ adds the phrase occurrences of one alignment, the ref tokens
+            of a phrase and the insertions between them
+        """
+        if not self.trie:
+            return
+        # running cor / sub / del counts before every ref token, and the
+        # insertions before it
+        n = len(lab)
+        cor = array('i', [0]) * (n + 1)
+        sub = array('i', [0]) * (n + 1)
+        dels = array('i', [0]) * (n + 1)
+        inserted = array('i', [0]) * (n + 1)
+        counts = [0, 0, 0, 0, 0]
+        i = 0
+        for op in ops:
+            counts[op] += 1
+            if op != OP_INS:
+                inserted[i] = counts[OP_INS]
+                i += 1
+                cor[i] = counts[OP_COR]
+                sub[i] = counts[OP_SUB]
+                dels[i] = counts[OP_DEL]
+        data = self.data
+        trie = self.trie
+        end = self.END
+        for start in range(n):
+            node = trie.get(lab[start])
+            stop = start
+            while node is not None:
+                stop += 1
+                phrase = node.get(end)
+                if phrase is not None:
+                    data['all'][phrase] += stop - start
+                    data['cor'][phrase] += cor[stop] - cor[start]
+                    data['sub'][phrase] += sub[stop] - sub[start]
+                    data['del'][phrase] += dels[stop] - dels[start]
+                    data['ins'][phrase] += (inserted[stop - 1] -
+                                            inserted[start])
+                if stop == n:
+                    break
+                node = node.get(lab[stop])
+
+    def results(self, calculator):
+        """ [(name, result)] in file order
+        """
+        results = [{'all': 0, 'cor': 0, 'sub': 0, 'ins': 0, 'del': 0}
+                   for _ in self.names]
+        for source, entries in ((calculator.data, self.tokens.items()),
+                                (self.data, enumerate(self.phrases))):
+            size = len(source['all'])
+            for token, clusters in entries:
+                if token >= size:
+                    continue
+                for idx in clusters:
+                    for name in results[idx]:
+                        results[idx][name] += source[name][token]
+        return list(zip(self.names, results))
+
+
+def score_system(hyp_file, refs, tokenizer, band=True, cache=None):
+    """ scores hyp_file against refs, a list of (fid, ref tokens) encoded
+        by tokenizer, and returns (overall, {cluster: result}, unmatched).
+        Alignments are looked up in and added to cache, an AlignmentCache,
+        when given
+    """
+    calculator = Calculator(tokenizer.vocab)
+    calculator.band = band
+    rec_set = dict(read_utts(codecs.open(hyp_file, 'r', 'utf-8'), tokenizer))
+    unmatched = {'ref': 0, 'hyp': 0}
+    default_words = {}
+    default_clusters = {}
+    # per ref utterance errors and ref length, -1 when not in hyp_file
+    utt_errors = array('q', [-1]) * len(refs)
+    utt_counts = array('q', [-1]) * len(refs)
+    position = {fid: idx for idx, (fid, _) in enumerate(refs)}
+    for fid, lab, rec in dict_join(refs, rec_set, unmatched):
+        add_default_clusters(rec + lab, tokenizer.vocab, default_words,
+                             default_clusters)
+        key = ops = None
+        if cache is not None:
+            key = cache.key(tokenizer.vocab.decode(lab),
+                            tokenizer.vocab.decode(rec))
+            ops = cache.get(key)
+        result = calculator.calculate(lab, rec, ops)
+        if ops is None and cache is not None:
+            cache.put(key, result['ops'])
+        idx = position[fid]
+        utt_errors[idx] = result['sub'] + result['del'] + result['ins']
+        utt_counts[idx] = result['all']
+    clusters = {
+        name: calculator.cluster(words)
+        for name, words in default_clusters.items()
+    }
+    return (calculator.overall(), clusters, unmatched,
+            (utt_errors, utt_counts))
+
+
+# refs, tokenizer, band and cache arguments shared by the score_systems
+# workers
+system_context = None
+
+
+def init_system_worker(context):
+    global system_context
+    system_context = context
+
+
+def score_system_worker(hyp_file):
+    refs, tokenizer, band, cache_args = system_context
+    if cache_args is None:
+        return score_system(hyp_file, refs, tokenizer, band), None
+    # only the main process writes the cache file
+    cache = AlignmentCache(*cache_args, deferred=True)
+    try:
+        score = score_system(hyp_file, refs, tokenizer, band, cache)
+    finally:
+        cache.db.close()
+    return score, (cache.updates, cache.hits, cache.misses)
+
+
+def score_systems(hyp_files, refs, tokenizer, band=True, jobs=None,
+                  cache=None):
+    """ scores several hyp files against the same tokenized refs, one
+        process per system, and returns their score_system results in
+        order
+    """
+    jobs = min(len(hyp_files), jobs or os.cpu_count() or 1)
+    if jobs <= 1:
+        return [score_system(hyp_file, refs, tokenizer, band, cache)
+                for hyp_file in hyp_files]
+    if cache is not None:
+        # the workers read the file while it has no pending writes
+        cache.db.commit()
+    cache_args = cache.args if cache is not None else None
+    with multiprocessing.Pool(jobs, init_system_worker,
+                              ((refs, tokenizer, band, cache_args), )) as pool:
+        results = pool.map(score_system_worker, hyp_files, chunksize=1)
+    for _, updates in results:
+        if updates is not None:
+            cache.apply(*updates)
+    return [score for score, _ in results]
+
+
+def print_systems(hyp_files, scores, out=sys.stdout):
+    """ side by side table of Overall, Correct and per cluster error rates
+    """
+    cluster_names = []
+    for _, clusters, _, _ in scores:
+        for name in clusters:
+            if name not in cluster_names:
+                cluster_names.append(name)
+    header = ['System', 'Overall', 'Correct', 'N', 'C', 'S', 'D', 'I']
+    rows = [header + cluster_names]
+    for hyp_file, (result, clusters, _, _) in zip(hyp_files, scores):
+        if result['all'] != 0:
+            correct = float(result['cor']) * 100.0 / result['all']
+        else:
+            correct = 0.0
+        row = [hyp_file, '%4.2f %%' % error_rate(result), '%4.2f %%' % correct]
+        row += ['%d' % result[name] for _, name in REPORT_COUNTS]
+        row += [
+            '%4.2f %%' % error_rate(clusters[name]) if name in clusters else '-'
+            for name in cluster_names
+        ]
+        rows.append(row)
+    widths = [
+        max(width(row[col]) for row in rows) for col in range(len(rows[0]))
+    ]
+    for row in rows:
+        cells = [row[0] + ' ' * (widths[0] - width(row[0]))]
+        cells += [' ' * (w - width(cell)) + cell
+                  for cell, w in zip(row[1:], widths[1:])]
+        out.write('  '.join(cells) + '\n')
+
+
+def bootstrap_rates(systems, replicates=1000, seed=0):
+    """ systems holds (errors, counts) per-utterance arrays of the same
+        utterances. Returns a replicates x len(systems) numpy array of
+        error rates (%) over utterance sets resampled with replacement,
+        the same resamples for every system.
+    """
+    import numpy as np
+    errors = np.stack([np.asarray(e, dtype=np.float64) for e, _ in systems])
+    counts = np.stack([np.asarray(c, dtype=np.float64) for _, c in systems])
+    n = errors.shape[1]
+    rng = np.random.default_rng(seed)
+    rates = np.zeros((replicates, len(systems)))
+    batch = max(1, BOOTSTRAP_BATCH_CELLS // max(1, n))
+    for start in range(0, replicates, batch):
+        stop = min(replicates, start + batch)
+        idx = rng.integers(0, n, size=(stop - start, n))
+        for k in range(len(systems)):
+            sampled_errors = errors[k][idx].sum(axis=1)
+            sampled_counts = counts[k][idx].sum(axis=1)
+            rates[start:stop, k] = (100.0 * sampled_errors /
+                                    np.maximum(sampled_counts, 1.0))
+    return rates
+
+
+def bootstrap_interval(errors, counts, replicates=1000, alpha=0.05, seed=0):
+    """ percentile bootstrap confidence interval of the error rate (%)
+    """
+    import numpy as np
+    rates = bootstrap_rates([(errors, counts)], replicates, seed)[:, 0]
+    low, high = np.percentile(rates, [50.0 * alpha, 100.0 - 50.0 * alpha])
+    return float(low), float(high)
+
+
+def paired_bootstrap(base, system, replicates=1000, alpha=0.05, seed=0):
+    """ paired bootstrap test of system against base, both (errors,
+        counts) arrays, compared on the utterances scored in both (count
+        >= 0). Returns (delta, low, high, p): the error rate difference
+        system - base, its confidence interval, and the share of resamples
+        where the difference does not keep the sign of delta.
+    """
+    import numpy as np
+    base_errors, base_counts = (np.asarray(x) for x in base)
+    errors, counts = (np.asarray(x) for x in system)
+    both = (base_counts >= 0) & (counts >= 0)
+    base = (base_errors[both], base_counts[both])
+    system = (errors[both], counts[both])
+    delta = (100.0 * system[0].sum() / max(1, system[1].sum()) -
+             100.0 * base[0].sum() / max(1, base[1].sum()))
+    rates = bootstrap_rates([base, system], replicates, seed)
+    deltas = rates[:, 1] - rates[:, 0]
+    low, high = np.percentile(deltas, [50.0 * alpha, 100.0 - 50.0 * alpha])
+    if delta < 0:
+        p = np.mean(deltas >= 0)
+    elif delta > 0:
+        p = np.mean(deltas <= 0)
+    else:
+        p = 1.0
+    return float(delta), float(low), float(high), float(p)
+
+
+def print_bootstrap(hyp_files, scores, replicates, seed=0, out=sys.stdout):
+    """ confidence interval of every system, and a paired test of every
+        other system against the first one
+    """
+    matched = []
+    for utt_errors, utt_counts in (score[3] for score in scores):
+        keep = [idx for idx, count in enumerate(utt_counts) if count >= 0]
+        matched.append(([utt_errors[idx] for idx in keep],
+                        [utt_counts[idx] for idx in keep]))
+    for hyp_file, (errors, counts) in zip(hyp_files, matched):
+        low, high = bootstrap_interval(errors, counts, replicates, seed=seed)
+        out.write('%s -> 95%% CI [%4.2f %%, %4.2f %%] B=%d\n' %
+                  (hyp_file, low, high, replicates))
+    for hyp_file, score in zip(hyp_files[1:], scores[1:]):
+        delta, low, high, p = paired_bootstrap(scores[0][3], score[3],
+                                               replicates, seed=seed)
+        out.write('%s vs %s -> %+4.2f %% 95%% CI [%+4.2f %%, %+4.2f %%] '
+                  'p=%.4f\n' % (hyp_file, hyp_files[0], delta, low, high, p))
+
+
+def utterance_error_rate(result):
+    if result['all'] != 0:
+        return float(result['ins'] + result['sub'] +
+                     result['del']) * 100.0 / result['all']
+    if result['sub'] != 0 or result['ins'] != 0 or result['del'] != 0:
+        return 100.0
+    return 0.0
+
+
+def error_rate(result):
+    if result['all'] != 0:
+        return float(result['ins'] + result['sub'] +
+                     result['del']) * 100.0 / result['all']
+    return 0.0
+
+
+class UtteranceStats:
+    """ per-utterance errors, ref lengths and error rates in compact
+        arrays, the worst n utterances by errors (by='abs') or by error
+        rate (by='rel') are kept in a bounded heap while scoring
+    """
+
+    def __init__(self, worst=0, by='abs'):
+        self.errors = array('q')
+        self.counts = array('q')
+        self.rates = array('d')
+        self.worst = worst
+        self.by = by
+        self.heap = []
+
+    def __len__(self):
+        return len(self.rates)
+
+    def add(self, fid, result):
+        errors = result['sub'] + result['del'] + result['ins']
+        rate = utterance_error_rate(result)
+        seq = len(self.rates)
+        self.errors.append(errors)
+        self.counts.append(result['all'])
+        self.rates.append(rate)
+        if self.worst > 0:
+            if self.by == 'rel':
+                key = (rate, errors)
+            else:
+                key = (errors, rate)
+            # the earlier utterance wins a tie
+            item = (key, -seq, fid, result['all'])
+            if len(self.heap) < self.worst:
+                heapq.heappush(self.heap, item)
+            elif item > self.heap[0]:
+                heapq.heapreplace(self.heap, item)
+
+    def worst_utterances(self):
+        """ [(fid, errors, N, rate)], worst first
+        """
+        items = sorted(self.heap, reverse=True)
+        return [(fid, self.errors[-seq], count, self.rates[-seq])
+                for _, seq, fid, count in items]
+
+    def percentiles(self, qs=UTT_PERCENTILES):
+        """ [(q, rate)] interpolated between the closest ranks
+        """
+        rates = sorted(self.rates)
+        if not rates:
+            return [(q, 0.0) for q in qs]
+        out = []
+        for q in qs:
+            pos = (len(rates) - 1) * q / 100.0
+            low = int(pos)
+            high = min(low + 1, len(rates) - 1)
+            out.append((q, rates[low] + (rates[high] - rates[low]) *
+                        (pos - low)))
+        return out
+
+    def histogram(self, edges=UTT_HISTOGRAM_EDGES):
+        """ [(low, high, count)], the last bin is [edges[-1], inf)
+        """
+        bins = [0] * len(edges)
+        for rate in self.rates:
+            bins[bisect.bisect_right(edges, rate) - 1] += 1
+        highs = list(edges[1:]) + [float('inf')]
+        return list(zip(edges, highs, bins))
+
+
+class Utterance:
+    """ per-utterance result kept by a Scorer, lab and rec are the aligned
+        token ids (0 for a gap), dels is the deletion count
+    """
+    __slots__ = ('key', 'lab', 'rec', 'ops', 'all', 'cor', 'sub', 'ins',
+                 'dels')
+
+    def __init__(self, key, result):
+        """ result of Calculator.calculate(..., ids=True)
+        """
+        self.key = key
+        self.lab = result['lab']
+        self.rec = result['rec']
+        self.ops = result['ops']
+        self.all = result['all']
+        self.cor = result['cor']
+        self.sub = result['sub']
+        self.ins = result['ins']
+        self.dels = result['del']
+
+    def counts(self):
+        return {'all': self.all, 'cor': self.cor, 'sub': self.sub,
+                'ins': self.ins, 'del': self.dels}
+
+    def error_rate(self):
+        return utterance_error_rate(self.counts())
+
+
+class Scorer:
+    """ in-process scoring, the same numbers as the script:
+
+        scorer = Scorer(tochar=True)
+        for key, ref, hyp in utts:
+            scorer.add(key, ref, hyp)
+        scorer.overall()['wer']
+
+        ref and hyp are the text after the utterance id, or token lists
+    """
+
+    def __init__(self, tochar=False, ignore_words=(), cs=False, split=None,
+                 remove_tag=True, band=True):
+        if not cs:
+            ignore_words = set(w.upper() for w in ignore_words)
+            if split:
+                split = {w.upper(): [x.upper() for x in words]
+                         for w, words in split.items()}
+        self.vocab = Vocab()
+        self.tokenizer = Tokenizer(tochar, set(ignore_words), cs, split,
+                                   remove_tag, self.vocab)
+        self.calculator = Calculator(self.vocab)
+        self.calculator.band = band
+        self.default_words = {}
+        self.default_clusters = {}
+        self.utterances = []
+
+    def tokenize(self, text):
+        if isinstance(text, str):
+            text = self.tokenizer.tokens(text)
+        return self.tokenizer.normalize(text)
+
+    def add(self, key, ref, hyp):
+        """ scores one utterance and returns its Utterance
+        """
+        lab = self.tokenize(ref)
+        rec = self.tokenize(hyp)
+        add_default_clusters(rec + lab, self.vocab, self.default_words,
+                             self.default_clusters)
+        utt = Utterance(key, self.calculator.calculate(lab, rec, ids=True))
+        self.utterances.append(utt)
+        return utt
+
+    def overall(self):
+        result = self.calculator.overall()
+        result['wer'] = error_rate(result)
+        return result
+
+    def per_cluster(self):
+        clusters = {}
+        for name, words in self.default_clusters.items():
+            result = self.calculator.cluster(words)
+            result['wer'] = error_rate(result)
+            clusters[name] = result
+        return clusters
+
+    def confusions(self, k=10, cluster=None):
+        """ top k (ref, hyp, count) substitutions, overall or of one
+            default cluster
+        """
+        data = None
+        if cluster is not None:
+            data = self.default_clusters.get(cluster, ())
+        return self.calculator.top_confusions(k, data)
+
+    def to_json(self, utterances=False):
+        data = {'overall': self.overall(), 'clusters': self.per_cluster()}
+        if utterances:
+            tokens = self.vocab.tokens
+            data['utterances'] = [
+                dict(utt.counts(), key=utt.key, wer=utt.error_rate(),
+                     lab=[tokens[idx] for idx in utt.lab],
+                     rec=[tokens[idx] for idx in utt.rec])
+                for utt in self.utterances
+            ]
+        return json.dumps(data, ensure_ascii=False)
+
+
+class TextReport:
+    """ the classic report, every utterance block is built in memory and
+        written at once
+    """
+
+    def __init__(self, out, verbose=1, max_words_per_line=sys.maxsize,
+                 padding_symbol=' '):
+        self.out = out
+        self.verbose = verbose
+        self.max_words_per_line = max_words_per_line
+        self.padding_symbol = padding_symbol
+
+    def utterance(self, fid, result):
+        parts = ['\nutt: %s\n' % fid]
+        parts.append('CER: %4.2f %% ' % utterance_error_rate(result))
+        parts.append('N=%d C=%d S=%d D=%d I=%d\n' %
+                     (result['all'], result['cor'], result['sub'],
+                      result['del'], result['ins']))
+        lab = result['lab']
+        rec = result['rec']
+        pad_lab = []
+        pad_rec = []
+        for lab_token, rec_token in zip(lab, rec):
+            len_lab = width(lab_token)
+            len_rec = width(rec_token)
+            length = max(len_lab, len_rec)
+            pad_lab.append(self.padding_symbol * (length - len_lab) + ' ')
+            pad_rec.append(self.padding_symbol * (length - len_rec) + ' ')
+        if self.verbose > 1:
+            lab_head = 'lab(%s): ' % fid.encode('utf-8')
+            rec_head = 'rec(%s): ' % fid.encode('utf-8')
+        else:
+            lab_head = 'lab: '
+            rec_head = 'rec: '
+        upper = len(lab)
+        start = 0
+        while start < upper:
+            stop = min(upper, start + self.max_words_per_line)
+            parts.append(lab_head)
+            for idx in range(start, stop):
+                parts.append('%s%s' % (lab[idx], pad_lab[idx]))
+            parts.append('\n')
+            parts.append(rec_head)
+            for idx in range(start, stop):
+                parts.append('%s%s' % (rec[idx], pad_rec[idx]))
+            parts.append('\n\n')
+            start = stop
+        self.out.write(''.join(parts))
+
+    def begin_summary(self):
+        if self.verbose:
+            self.out.write('==================================================='
+                           '========================\n\n')
+
+    def overall(self, result):
+        if result['all'] != 0:
+            correct = float(result['cor']) * 100.0 / result['all']
+        else:
+            correct = 0.0
+        self.out.write('Overall -> %4.2f %% N=%d C=%d S=%d D=%d I=%d\n'
+                       'Correct -> %4.2f %% N=%d C=%d \n' %
+                       (error_rate(result), result['all'], result['cor'],
+                        result['sub'], result['del'], result['ins'],
+                        correct, result['all'], result['cor']))
+        if not self.verbose:
+            self.out.write('\n')
+
+    def cluster(self, name, result):
+        self.out.write('%s -> %4.2f %% N=%d C=%d S=%d D=%d I=%d\n' %
+                       (name, error_rate(result), result['all'],
+                        result['cor'], result['sub'], result['del'],
+                        result['ins']))
+
+    def interval(self, name, low, high, replicates):
+        self.out.write('%s 95%% CI -> [%4.2f %%, %4.2f %%] B=%d\n' %
+                       (name, low, high, replicates))
+
+    def confusions(self, name, pairs):
+        parts = ['%s confusions -> %d\n' % (name, len(pairs))]
+        for ref, hyp, count in pairs:
+            parts.append('  %s -> %s %d\n' % (ref, hyp, count))
+        self.out.write(''.join(parts))
+
+    def distribution(self, percentiles, histogram):
+        self.out.write('Percentiles -> %s\n' % ' '.join(
+            'P%d=%4.2f %%' % (q, rate) for q, rate in percentiles))
+        self.out.write('Histogram -> %s\n' % ' '.join(
+            '[%g, %g)=%d' % (low, high, count)
+            for low, high, count in histogram))
+
+    def worst(self, utts):
+        parts = ['Worst %d -> \n' % len(utts)]
+        for fid, errors, count, rate in utts:
+            parts.append('  %s CER: %4.2f %% E=%d N=%d\n' %
+                         (fid, rate, errors, count))
+        self.out.write(''.join(parts))
+
+    def end(self):
+        if self.verbose:
+            self.out.write('\n======================================='
+                           '====================================\n')
+
+
+class JsonlReport(TextReport):
+    """ one json record per utterance, then the overall and cluster
+        records, told apart by their type
+    """
+
+    def record(self, kind, name, result, wer):
+        record = {'type': kind, 'name': name, 'wer': round(wer, 4)}
+        for key, name in REPORT_COUNTS:
+            record[key] = result[name]
+        return record
+
+    def utterance(self, fid, result):
+        record = self.record('utt', fid, result, utterance_error_rate(result))
+        record['ali'] = [list(pair) for pair in zip(result['lab'],
+                                                     result['rec'])]
+        self.out.write(json.dumps(record, ensure_ascii=False) + '\n')
+
+    def begin_summary(self):
+        pass
+
+    def overall(self, result):
+        record = self.record('overall', 'Overall', result, error_rate(result))
+        self.out.write(json.dumps(record, ensure_ascii=False) + '\n')
+
+    def cluster(self, name, result):
+        record = self.record('cluster', name, result, error_rate(result))
+        self.out.write(json.dumps(record, ensure_ascii=False) + '\n')
+
+    def interval(self, name, low, high, replicates):
+        record = {'type': 'interval', 'name': name, 'low': round(low, 4),
+                  'high': round(high, 4), 'replicates': replicates}
+        self.out.write(json.dumps(record, ensure_ascii=False) + '\n')
+
+    def confusions(self, name, pairs):
+        for ref, hyp, count in pairs:
+            record = {'type': 'confusion', 'name': name, 'ref': ref,
+                      'hyp': hyp, 'count': count}
+            self.out.write(json.dumps(record, ensure_ascii=False) + '\n')
+
+    def distribution(self, percentiles, histogram):
+        for q, rate in percentiles:
+            record = {'type': 'percentile', 'name': 'P%d' % q,
+                      'wer': round(rate, 4)}
+            self.out.write(json.dumps(record) + '\n')
+        for low, high, count in histogram:
+            record = {'type': 'histogram', 'low': low,
+                      'high': high if high != float('inf') else None,
+                      'count': count}
+            self.out.write(json.dumps(record) + '\n')
+
+    def worst(self, utts):
+        for fid, errors, count, rate in utts:
+            record = {'type': 'worst', 'name': fid, 'wer': round(rate, 4),
+                      'E': errors, 'N': count}
+            self.out.write(json.dumps(record, ensure_ascii=False) + '\n')
+
+    def end(self):
+        pass
+
+
+class TsvReport(JsonlReport):
+    """ the records of JsonlReport as tab separated rows, the aligned
+        tokens joined by spaces with * for a gap, a confusion row has
+        its count in the S column, a histogram row in the N column, an
+        interval row its replicates B in the N column and the low and
+        high bounds in the ref and hyp columns, a worst row its error
+        count in the S column
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.out.write('\t'.join(['type', 'name', 'wer'] +
+                                 [key for key, _ in REPORT_COUNTS] +
+                                 ['ref', 'hyp']) + '\n')
+
+    def row(self, record, lab=(), rec=()):
+        fields = [record['type'], record['name'], '%.2f' % record['wer']]
+        fields += [str(record[key]) for key, _ in REPORT_COUNTS]
+        fields.append(' '.join(token or '*' for token in lab))
+        fields.append(' '.join(token or '*' for token in rec))
+        self.out.write('\t'.join(fields) + '\n')
+
+    def utterance(self, fid, result):
+        self.row(self.record('utt', fid, result, utterance_error_rate(result)),
+                 result['lab'], result['rec'])
+
+    def overall(self, result):
+        self.row(self.record('overall', 'Overall', result, error_rate(result)))
+
+    def cluster(self, name, result):
+        self.row(self.record('cluster', name, result, error_rate(result)))
+
+    def interval(self, name, low, high, replicates):
+        self.out.write('interval\t%s\t\t%d\t\t\t\t\t%.2f\t%.2f\n' %
+                       (name, replicates, low, high))
+
+    def confusions(self, name, pairs):
+        for ref, hyp, count in pairs:
+            self.out.write('confusion\t%s\t\t\t\t%d\t\t\t%s\t%s\n' %
+                           (name, count, ref, hyp))
+
+    def distribution(self, percentiles, histogram):
+        for q, rate in percentiles:
+            self.out.write('percentile\tP%d\t%.2f\t\t\t\t\t\t\t\n' %
+                           (q, rate))
+        for low, high, count in histogram:
+            self.out.write('histogram\t[%g, %g)\t\t%d\t\t\t\t\t\t\n' %
+                           (low, high, count))
+
+    def worst(self, utts):
+        for fid, errors, count, rate in utts:
+            self.out.write('worst\t%s\t%.2f\t%d\t\t%d\t\t\t\t\n' %
+                           (fid, rate, count, errors))
+
+
+REPORT_FORMATS = {'text': TextReport, 'jsonl': JsonlReport, 'tsv': TsvReport}
+# options of the single hyp report with no counterpart in print_systems
+MULTI_HYP_UNSUPPORTED = ('--format', '--cluster', '--confusions', '--dist',
+                         '--worst', '--worst-by', '--v', '--maxw',
+                         '--padding-symbol', '--sorted', '--sort')
+REPORT_COUNTS = (('N', 'all'), ('C', 'cor'), ('S', 'sub'), ('D', 'del'),
+                 ('I', 'ins'))
 
 
 def usage():
@@ -296,14 +1696,20 @@ def usage():
           and align recognition results and references.")
     print("         usage : python compute-wer.py [--cs={0,1}] \
           [--cluster=foo] [--ig=ignore_file] [--char={0,1}] [--v={0,1}] \
-          [--padding-symbol={space,underline}] test.ref test.hyp > test.wer")
+          [--padding-symbol={space,underline}] [--jobs=N] [--band={0,1}] \
+          [--sorted={0,1}] [--sort={0,1}] [--format={text,jsonl,tsv}] \
+          [--cache=file] [--cache-size=MB] [--bootstrap=B] [--seed=N] \
+          [--confusions=K] [--dist={0,1}] [--worst=N] \
+          [--worst-by={abs,rel}] \
+          test.ref test.hyp [more.hyp ...] > test.wer")
 
 
 if __name__ == '__main__':
     if len(sys.argv) == 1:
         usage()
         sys.exit(0)
-    calculator = Calculator()
+    vocab = Vocab()
+    calculator = Calculator(vocab)
     cluster_file = ''
     ignore_words = set()
     tochar = False
@@ -311,14 +1717,54 @@ if __name__ == '__main__':
     padding_symbol = ' '
     case_sensitive = False
     max_words_per_line = sys.maxsize
+    jobs = 1
+    band = True
+    sorted_inputs = False
+    sort_inputs = False
+    report_format = 'text'
+    cache_file = ''
+    cache_size = CACHE_MAX_BYTES
+    replicates = 0
+    seed = 0
+    remove_tag = True
+    top_confusions = 0
+    distribution = False
+    worst = 0
+    worst_by = 'abs'
     split = None
-    while len(sys.argv) > 3:
+    options = set()
+    while len(sys.argv) > 3 and sys.argv[1].startswith('-'):
+        options.add(sys.argv[1].split('=', 1)[0])
         a = '--maxw='
         if sys.argv[1].startswith(a):
             b = sys.argv[1][len(a):]
             del sys.argv[1]
             max_words_per_line = int(b)
             continue
+        a = '--jobs='
+        if sys.argv[1].startswith(a):
+            b = sys.argv[1][len(a):]
+            del sys.argv[1]
+            jobs = max(1, int(b))
+            continue
+        a = '--band='
+        if sys.argv[1].startswith(a):
+            b = sys.argv[1][len(a):].lower()
+            del sys.argv[1]
+            band = (b == 'true') or (b != '0')
+            continue
+        a = '--sorted='
+        if sys.argv[1].startswith(a):
+            b = sys.argv[1][len(a):].lower()
+            del sys.argv[1]
+            sorted_inputs = (b == 'true') or (b != '0')
+            continue
+        a = '--sort='
+        if sys.argv[1].startswith(a):
+            b = sys.argv[1][len(a):].lower()
+            del sys.argv[1]
+            sort_inputs = (b == 'true') or (b != '0')
+            continue
         a = '--rt='
         if sys.argv[1].startswith(a):
             b = sys.argv[1][len(a):].lower()
@@ -374,6 +1820,61 @@ if __name__ == '__main__':
                 if b == 'true' or b != '0':
                     verbose = 1
             continue
+        a = '--cache='
+        if sys.argv[1].startswith(a):
+            cache_file = sys.argv[1][len(a):]
+            del sys.argv[1]
+            continue
+        a = '--cache-size='
+        if sys.argv[1].startswith(a):
+            b = sys.argv[1][len(a):]
+            del sys.argv[1]
+            cache_size = int(float(b) * (1 << 20))
+            continue
+        a = '--bootstrap='
+        if sys.argv[1].startswith(a):
+            b = sys.argv[1][len(a):]
+            del sys.argv[1]
+            replicates = int(b)
+            continue
+        a = '--seed='
+        if sys.argv[1].startswith(a):
+            b = sys.argv[1][len(a):]
+            del sys.argv[1]
+            seed = int(b)
+            continue
+        a = '--confusions='
+        if sys.argv[1].startswith(a):
+            b = sys.argv[1][len(a):]
+            del sys.argv[1]
+            top_confusions = int(b)
+            continue
+        a = '--dist='
+        if sys.argv[1].startswith(a):
+            b = sys.argv[1][len(a):].lower()
+            del sys.argv[1]
+            distribution = (b == 'true') or (b != '0')
+            continue
+        a = '--worst='
+        if sys.argv[1].startswith(a):
+            b = sys.argv[1][len(a):]
+            del sys.argv[1]
+            worst = int(b)
+            continue
+        a = '--worst-by='
+        if sys.argv[1].startswith(a):
+            b = sys.argv[1][len(a):].lower()
+            del sys.argv[1]
+            if b in ('abs', 'rel'):
+                worst_by = b
+            continue
+        a = '--format='
+        if sys.argv[1].startswith(a):
+            b = sys.argv[1][len(a):].lower()
+            del sys.argv[1]
+            if b in REPORT_FORMATS:
+                report_format = b
+            continue
         a = '--padding-symbol='
         if sys.argv[1].startswith(a):
             b = sys.argv[1][len(a):].lower()
@@ -388,6 +1889,7 @@ if __name__ == '__main__':
             del sys.argv[1]
             continue
 
+    calculator.band = band
     if not case_sensitive:
         ig = set([w.upper() for w in ignore_words])
         ignore_words = ig
@@ -397,6 +1899,7 @@ if __name__ == '__main__':
 
     ref_file = sys.argv[1]
     hyp_file = sys.argv[2]
+    hyp_files = sys.argv[2:]
     rec_set = {}
     if split and not case_sensitive:
         newsplit = dict()
@@ -407,163 +1910,124 @@ if __name__ == '__main__':
             newsplit[w.upper()] = words
         split = newsplit
 
-    with codecs.open(hyp_file, 'r', 'utf-8') as fh:
-        for line in fh:
-            if tochar:
-                array = characterize(line)
-            else:
-                array = line.strip().split()
-            if len(array) == 0:
-                continue
-            fid = array[0]
-            rec_set[fid] = normalize(array[1:], ignore_words, case_sensitive,
-                                     split)
+    if sort_inputs:
+        sort_dir = tempfile.TemporaryDirectory()
+        ref_file = sort_by_key(ref_file, sort_dir.name)
+        hyp_file = sort_by_key(hyp_file, sort_dir.name)
+        sorted_inputs = True
 
-    # compute error rate on the interaction of reference file and hyp file
-    for line in open(ref_file, 'r', encoding='utf-8'):
-        if tochar:
-            array = characterize(line)
-        else:
-            array = line.rstrip('\n').split()
-        if len(array) == 0:
-            continue
-        fid = array[0]
-        if fid not in rec_set:
-            continue
-        lab = normalize(array[1:], ignore_words, case_sensitive, split)
-        rec = rec_set[fid]
-        if verbose:
-            print('\nutt: %s' % fid)
-
-        for word in rec + lab:
-            if word not in default_words:
-                default_cluster_name = default_cluster(word)
-                if default_cluster_name not in default_clusters:
-                    default_clusters[default_cluster_name] = {}
-                if word not in default_clusters[default_cluster_name]:
-                    default_clusters[default_cluster_name][word] = 1
-                default_words[word] = default_cluster_name
-
-        result = calculator.calculate(lab, rec)
-        if verbose:
-            if result['all'] != 0:
-                wer = float(result['ins'] + result['sub'] +
-                            result['del']) * 100.0 / result['all']
-            else:
-                if result['sub'] != 0 or result['ins'] != 0 or result['del'] != 0:
-                    wer = 100.0
-                else:
-                    wer = 0.0
-            
-            print('CER: %4.2f %%' % wer, end=' ')
-            print('N=%d C=%d S=%d D=%d I=%d' %
-                  (result['all'], result['cor'], result['sub'], result['del'],
-                   result['ins']))
-            space = {}
-            space['lab'] = []
-            space['rec'] = []
-            for idx in range(len(result['lab'])):
-                len_lab = width(result['lab'][idx])
-                len_rec = width(result['rec'][idx])
-                length = max(len_lab, len_rec)
-                space['lab'].append(length - len_lab)
-                space['rec'].append(length - len_rec)
-            upper_lab = len(result['lab'])
-            upper_rec = len(result['rec'])
-            lab1, rec1 = 0, 0
-            while lab1 < upper_lab or rec1 < upper_rec:
-                if verbose > 1:
-                    print('lab(%s):' % fid.encode('utf-8'), end=' ')
-                else:
-                    print('lab:', end=' ')
-                lab2 = min(upper_lab, lab1 + max_words_per_line)
-                for idx in range(lab1, lab2):
-                    token = result['lab'][idx]
-                    print('{token}'.format(token=token), end='')
-                    for n in range(space['lab'][idx]):
-                        print(padding_symbol, end='')
-                    print(' ', end='')
-                print()
-                if verbose > 1:
-                    print('rec(%s):' % fid.encode('utf-8'), end=' ')
-                else:
-                    print('rec:', end=' ')
-                rec2 = min(upper_rec, rec1 + max_words_per_line)
-                for idx in range(rec1, rec2):
-                    token = result['rec'][idx]
-                    print('{token}'.format(token=token), end='')
-                    for n in range(space['rec'][idx]):
-                        print(padding_symbol, end='')
-                    print(' ', end='')
-                print('\n', end='\n')
-                lab1 = lab2
-                rec1 = rec2
+    tokenizer = Tokenizer(tochar, ignore_words, case_sensitive, split,
+                          remove_tag, vocab)
+    cache = None
+    if cache_file:
+        cache = AlignmentCache(cache_file, cache_size,
+                               json.dumps(calculator.cost, sort_keys=True))
 
-    if verbose:
-        print('==================================================='
-              '========================')
-        print()
+    if len(hyp_files) > 1:
+        # the side by side table only has overall rates
+        unsupported = options & set(MULTI_HYP_UNSUPPORTED)
+        if report_format == 'text':
+            unsupported.discard('--format')
+        if unsupported:
+            print('%s not supported with several hyp files' %
+                  ', '.join(sorted(unsupported)), file=sys.stderr)
+            sys.exit(1)
+        # several systems against one ref, tokenized once
+        refs = list(read_utts(open(ref_file, 'r', encoding='utf-8'),
+                              tokenizer))
+        scores = score_systems(hyp_files, refs, tokenizer, band,
+                               jobs if jobs > 1 else None, cache)
+        if cache is not None:
+            cache.close()
+            print(cache.stats(), file=sys.stderr)
+        for hyp_file, (_, _, unmatched, _) in zip(hyp_files, scores):
+            if unmatched['ref'] or unmatched['hyp']:
+                print('unmatched utterances: %d only in %s, %d only in %s' %
+                      (unmatched['ref'], ref_file, unmatched['hyp'],
+                       hyp_file), file=sys.stderr)
+        print_systems(hyp_files, scores)
+        if replicates > 0:
+            print_bootstrap(hyp_files, scores, replicates, seed)
+        sys.exit(0)
 
-    result = calculator.overall()
-    if result['all'] != 0:
-        wer = float(result['ins'] + result['sub'] +
-                    result['del']) * 100.0 / result['all']
+    unmatched = {'ref': 0, 'hyp': 0}
+    hyp_fh = codecs.open(hyp_file, 'r', 'utf-8')
+    hyps = read_utts(hyp_fh, tokenizer)
+    refs = read_utts(open(ref_file, 'r', encoding='utf-8'), tokenizer)
+    if sorted_inputs:
+        pairs = merge_join(refs, hyps, unmatched)
     else:
-        wer = 0.0
-    print('Overall -> %4.2f %%' % wer, end=' ')
-    print('N=%d C=%d S=%d D=%d I=%d' %
-          (result['all'], result['cor'], result['sub'], result['del'],
-           result['ins']))
-    if result['all'] != 0:
-        correct = float(result['cor']) * 100.0 / result['all']
+        for fid, rec in hyps:
+            rec_set[fid] = rec
+        pairs = dict_join(refs, rec_set, unmatched)
+
+    report = REPORT_FORMATS[report_format](sys.stdout, verbose,
+                                           max_words_per_line, padding_symbol)
+
+    keywords = None
+    if cluster_file:
+        keywords = KeywordClusters(tokenizer).load(cluster_file)
+
+    def prepare(pairs):
+        for fid, lab, rec in pairs:
+            add_default_clusters(rec + lab, vocab, default_words,
+                                 default_clusters)
+            key = ops = None
+            if cache is not None:
+                key = cache.key(vocab.decode(lab), vocab.decode(rec))
+                ops = cache.get(key)
+            yield fid, lab, rec, ops, key
+
+    # compute error rate on the interaction of reference file and hyp file
+    stats = UtteranceStats(worst, worst_by)
+    if jobs > 1:
+        # the join keeps being read while the workers align
+        scored = score_parallel(prepare(pairs), calculator, jobs, verbose)
     else:
-        correct = 0.0
-    print('Correct -> %4.2f %%' % correct, end=' ')
-    print('N=%d C=%d ' % (result['all'], result['cor']))
-    if not verbose:
-        print()
+        scored = ((utt, calculator.calculate(*utt[1:4]))
+                  for utt in prepare(pairs))
+    for utt, result in scored:
+        fid, lab, _, ops, key = utt
+        if ops is None and cache is not None:
+            cache.put(key, result['ops'])
+        stats.add(fid, result)
+        if keywords is not None:
+            keywords.count(lab, result['ops'])
+        if verbose:
+            report.utterance(fid, result)
+
+    if cache is not None:
+        cache.close()
+        print(cache.stats(), file=sys.stderr)
+
+    if unmatched['ref'] or unmatched['hyp']:
+        print('unmatched utterances: %d only in %s, %d only in %s' %
+              (unmatched['ref'], sys.argv[1], unmatched['hyp'], sys.argv[2]),
+              file=sys.stderr)
+
+    report.begin_summary()
+    report.overall(calculator.overall())
+    if replicates > 0:
+        low, high = bootstrap_interval(stats.errors, stats.counts,
+                                       replicates, seed=seed)
+        report.interval('Overall', low, high, replicates)
 
     if verbose:
         for cluster_id in default_clusters:
             result = calculator.cluster(k
                                         for k in default_clusters[cluster_id])
-            if result['all'] != 0:
-                wer = float(result['ins'] + result['sub'] +
-                            result['del']) * 100.0 / result['all']
-            else:
-                wer = 0.0
-            print('%s -> %4.2f %%' % (cluster_id, wer), end=' ')
-            print('N=%d C=%d S=%d D=%d I=%d' %
-                  (result['all'], result['cor'], result['sub'], result['del'],
-                   result['ins']))
-        if len(cluster_file) > 0:  # compute separated WERs for word clusters
-            cluster_id = ''
-            cluster = []
-            for line in open(cluster_file, 'r', encoding='utf-8'):
-                for token in line.decode('utf-8').rstrip('\n').split():
-                    # end of cluster reached, like </Keyword>
-                    if token[0:2] == '</' and token[len(token) - 1] == '>' and \
-                       token.lstrip('</').rstrip('>') == cluster_id :
-                        result = calculator.cluster(cluster)
-                        if result['all'] != 0:
-                            wer = float(result['ins'] + result['sub'] +
-                                        result['del']) * 100.0 / result['all']
-                        else:
-                            wer = 0.0
-                        print('%s -> %4.2f %%' % (cluster_id, wer), end=' ')
-                        print('N=%d C=%d S=%d D=%d I=%d' %
-                              (result['all'], result['cor'], result['sub'],
-                               result['del'], result['ins']))
-                        cluster_id = ''
-                        cluster = []
-                    # begin of cluster reached, like <Keyword>
-                    elif (token[0] == '<' and token[len(token) - 1] == '>'
-                          and cluster_id == ''):
-                        cluster_id = token.lstrip('<').rstrip('>')
-                        cluster = []
-                    # general terms, like WEATHER / CAR / ...
-                    else:
-                        cluster.append(token)
-        print()
-        print('======================================='
-              '====================================')
\ No newline at end of file
+            report.cluster(cluster_id, result)
+        if keywords is not None:  # compute separated WERs for word clusters
+            for cluster_id, result in keywords.results(calculator):
+                report.cluster(cluster_id, result)
+    if distribution:
+        report.distribution(stats.percentiles(), stats.histogram())
+    if worst > 0:
+        report.worst(stats.worst_utterances())
+    if top_confusions > 0:
+        report.confusions('Overall',
+                          calculator.top_confusions(top_confusions))
+        for cluster_id in default_clusters:
+            report.confusions(cluster_id, calculator.top_confusions(
+                top_confusions, default_clusters[cluster_id]))
+    report.end()